@@ -0,0 +1,4 @@
+"""Microbenchmarks for the Private Metadata Viewer.
+
+Run them from the repository root, e.g. 'python benchmarks/bench_regions.py'.
+"""
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Benchmark MdMPRI rectangle parsing against the former eval() path."""
+
+from synthetic import mpri_image, bench
+from private_metadata import MdMPRI
+from lib.region import Region
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+def eval_parse(self, imageMetadata):
+    """The former MdMPRI.parse, evaluating each MPReg:Rectangle"""
+    if 'Xmp.MP.RegionInfo/MPRI:Regions' in imageMetadata:
+        i = 1
+        self.value = []
+        while 'Xmp.MP.RegionInfo/MPRI:Regions[%i]' % i in imageMetadata:
+            if 'Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:PersonDisplayName') in imageMetadata:
+                name = imageMetadata['Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:PersonDisplayName')].value
+                if 'Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:PersonLiveCID') in imageMetadata:
+                    name += ' (%s)' % imageMetadata['Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:PersonLiveCID')].value
+                if 'Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:Rectangle') in imageMetadata:
+                    r = imageMetadata['Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:Rectangle')].value
+                    left, top, width, height = eval(r)
+                    v = Region(self.FACE | self.RECTANGLE, name, self.name, left, top, width, height)
+                else:
+                    v = Region(self.FACE | self.ANYWHERE, name, self.name)
+            self.value.append(v)
+            i += 1
+        self.value = sorted(self.value)
+    else:
+        self.value = None
+
+
+def main():
+    r = '0.661608, 0.244310, 0.130501, 0.261002'
+    assert tuple(eval(r)) == MdMPRI.parseRectangle(r)
+    told = bench('eval rectangle', lambda: eval(r))
+    tnew = bench('parseRectangle', lambda: MdMPRI.parseRectangle(r))
+    print '%-40s %12.1fx' % ('speedup', told / tnew)
+    for regions in (1, 10, 100, 1000):
+        md = mpri_image(regions)
+        old, new = MdMPRI(None), MdMPRI(None)
+        eval_parse(old, md)
+        new.parse(md)
+        assert old.value == new.value
+        told = bench('eval parse, %i regions' % regions, lambda: eval_parse(old, md))
+        tnew = bench('parseRectangle parse, %i regions' % regions, lambda: new.parse(md))
+        print '%-40s %12.1fx' % ('speedup', told / tnew)
+
+
+if __name__ == '__main__':
+    main()
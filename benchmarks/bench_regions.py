@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Benchmark MdMwgRs.parse against the former key-probing parser."""
+
+from synthetic import mwgrs_image, bench
+from private_metadata import MdMwgRs
+from lib.region import Region
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+def probing_parse(self, imageMetadata):
+    """The former MdMwgRs.parse: probes formatted keys, sorts per region"""
+    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList' in imageMetadata:
+        i = 1
+        self.value = []
+        while 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]' % i in imageMetadata:
+            if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Area') in imageMetadata:
+                type = self.UNKNOWN
+                if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Type') in imageMetadata:
+                    t = imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Type')].value.lower()
+                    type = self.TYPES.get(t, self.UNKNOWN)
+                name = ''
+                if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Name') in imageMetadata:
+                    name = imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Name')].value
+                if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Description') in imageMetadata:
+                    imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Description')].value
+                area = []
+                for a in ('x', 'y', 'w', 'h', 'd'):
+                    k = 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, a)
+                    area.append(float(imageMetadata[k].value) if k in imageMetadata else float('-inf'))
+                xcenter, ycenter, width, height, diameter = area
+                if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'unit') in imageMetadata:
+                    imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'unit')].value
+                if (xcenter >= 0) and (ycenter >= 0):
+                    if (width >= 0) and (height >= 0):
+                        v = Region.fromCenter(type | self.RECTANGLE, name, self.name, xcenter, ycenter, width, height)
+                    elif (diameter >= 0):
+                        v = Region.fromCenter(type | self.CIRCLE, name, self.name, xcenter, ycenter, diameter, diameter)
+                    else:
+                        v = Region(type | self.POINT, name, self.name, xcenter, ycenter, 0.0, 0.0)
+                else:
+                    v = Region(type, name, self.name)
+                self.value.append(v)
+            i += 1
+            self.value = sorted(self.value)
+    else:
+        self.value = None
+
+
+def main():
+    for regions in (1, 10, 100, 1000):
+        md = mwgrs_image(regions)
+        old, new = MdMwgRs(None), MdMwgRs(None)
+        probing_parse(old, md)
+        new.parse(md)
+        assert old.value == new.value
+        told = bench('probing parse, %i regions' % regions, lambda: probing_parse(old, md))
+        tnew = bench('single-pass parse, %i regions' % regions, lambda: new.parse(md))
+        print '%-40s %12.1fx' % ('speedup', told / tnew)
+
+
+if __name__ == '__main__':
+    main()
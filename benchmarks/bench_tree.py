@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Benchmark building MetadataTrees with indexed against scanned children."""
+
+from synthetic import wide_image, bench
+from private_metadata import MetadataTree, splitKey
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class ScanningMetadataTree(MetadataTree):
+    """MetadataTree finding children by scanning all siblings, as formerly done"""
+    class Node(MetadataTree.Node):
+        def __init__(self, *args, **kwargs):
+            MetadataTree.Node.__init__(self, *args, **kwargs)
+            self.childindex = self
+        def get(self, name):
+            found = [child for child in self.children if child.name == name]
+            return found[0] if found else None
+        def setdefault(self, name, child):
+            pass
+        def __delitem__(self, name):
+            pass
+
+
+def multisplit(s, seps=['.','/'], nsprefix=True):
+    """The former key splitting of MetadataTree.loadMetadata"""
+    res = [s.replace('[', '.[')]
+    for sep in seps:
+        s, res = res, []
+        for seq in s:
+            res += seq.split(sep)
+    if nsprefix == True:
+        return res
+    else:
+        return [e.split(':')[-1] for e in res]
+
+
+def main():
+    keys = wide_image(10000).keys()
+    assert [tuple(multisplit(k, nsprefix=False)) for k in keys] == [splitKey(k, nsprefix=False) for k in keys]
+    told = bench('multisplit, %i keys' % len(keys), lambda: [multisplit(k, nsprefix=False) for k in keys])
+    tnew = bench('memoized splitKey, %i keys' % len(keys), lambda: [splitKey(k, nsprefix=False) for k in keys])
+    print '%-40s %12.1fx' % ('speedup', told / tnew)
+    for keys in (100, 1000, 10000):
+        md = wide_image(keys)
+        assert unicode(MetadataTree(md)) == unicode(ScanningMetadataTree(md))
+        told = bench('scanning tree, %i keys' % len(md), lambda: ScanningMetadataTree(md))
+        tnew = bench('indexed tree, %i keys' % len(md), lambda: MetadataTree(md))
+        print '%-40s %12.1fx' % ('speedup', told / tnew)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Synthetic image metadata for benchmarks.
+
+The metadata is held in memory and offers the subset of the
+pyexiv2.ImageMetadata interface the parsers use, so the benchmarks
+measure our code and not libexiv2.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jpeg_metadata import JpegHeaderMetadata
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class SyntheticMetadata(JpegHeaderMetadata):
+    """JpegHeaderMetadata filled from (key, value) pairs instead of a file
+
+    Like pyexiv2.ImageMetadata, membership tests scan the key lists."""
+    def __init__(self, items=()):
+        super(SyntheticMetadata, self).__init__()
+        for key, value in items:
+            self.add(key, value)
+    def __contains__(self, key):
+        return key in self.exif_keys or key in self.iptc_keys or key in self.xmp_keys
+
+
+def camera_exif():
+    """A handful of typical camera Exif tags"""
+    return [ ('Exif.Image.Make', 'Canon'),
+             ('Exif.Image.Model', 'Canon EOS 5D Mark II'),
+             ('Exif.Image.DateTime', '2012:07:19 14:11:50'),
+             ('Exif.Photo.ExposureTime', '1/200'),
+             ('Exif.Photo.FNumber', '56/10'),
+             ('Exif.Photo.ISOSpeedRatings', '400') ]
+
+
+def mwgrs_image(regions):
+    """Metadata of an image with the given number of MWG face regions"""
+    md = SyntheticMetadata(camera_exif())
+    p = 'Xmp.mwg-rs.Regions'
+    md.add(p, '')
+    md.add(p+'/mwg-rs:AppliedToDimensions', '')
+    md.add(p+'/mwg-rs:AppliedToDimensions/stDim:w', '4000')
+    md.add(p+'/mwg-rs:AppliedToDimensions/stDim:h', '3000')
+    md.add(p+'/mwg-rs:AppliedToDimensions/stDim:unit', 'pixel')
+    md.add(p+'/mwg-rs:RegionList', '')
+    for i in xrange(1, regions+1):
+        r = '%s/mwg-rs:RegionList[%i]' % (p, i)
+        md.add(r, '')
+        md.add(r+'/mwg-rs:Type', 'Face')
+        md.add(r+'/mwg-rs:Name', 'Person %05i' % (regions-i))
+        md.add(r+'/mwg-rs:Area', '')
+        md.add(r+'/mwg-rs:Area/stArea:x', '%f' % ((i % 97) / 97.0))
+        md.add(r+'/mwg-rs:Area/stArea:y', '%f' % ((i % 89) / 89.0))
+        md.add(r+'/mwg-rs:Area/stArea:w', '0.05')
+        md.add(r+'/mwg-rs:Area/stArea:h', '0.07')
+        md.add(r+'/mwg-rs:Area/stArea:unit', 'normalized')
+    return md
+
+
+def mpri_image(regions):
+    """Metadata of an image with the given number of MPRI face regions"""
+    md = SyntheticMetadata(camera_exif())
+    p = 'Xmp.MP.RegionInfo'
+    md.add(p, '')
+    md.add(p+'/MPRI:Regions', '')
+    for i in xrange(1, regions+1):
+        r = '%s/MPRI:Regions[%i]' % (p, i)
+        md.add(r, '')
+        md.add(r+'/MPReg:Rectangle', '%f, %f, 0.130501, 0.261002' % ((i % 97) / 97.0, (i % 89) / 89.0))
+        md.add(r+'/MPReg:PersonDisplayName', 'Person %05i' % (regions-i))
+    return md
+
+
+def wide_image(keys):
+    """Metadata of an image with about the given number of keys in wide namespaces"""
+    md = SyntheticMetadata(camera_exif())
+    for i in xrange(keys / 10):
+        md.add('Exif.Photo.0x%04x' % i, str(i))
+    regions = mwgrs_image((keys - len(md)) / 10)
+    for key in regions.xmp_keys:
+        md.add(key, regions[key].value)
+    return md
+
+
+def bench(label, func, number=None, repeat=3):
+    """Print the best time per call of func in ms, return it in seconds"""
+    if number is None:
+        number = 1
+        while min(timeit.repeat(func, number=number, repeat=1)) < 0.2 and number < 10**6:
+            number *= 10
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    print '%-40s %12.4f ms' % (label, best * 1000)
+    return best
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""Background downloads of image files from URLs
+
+The body is streamed in chunks to a temporary file in the destination
+directory, which is renamed to the destination when complete, so a
+partial download never shows up as an image file. Stalled servers time
+out. As soon as the JPEG headers have arrived they are handed to a
+callback, so metadata can be shown while the image data still loads.
+With a DownloadCache, URLs downloaded before are revalidated by a
+conditional request and not downloaded again while unchanged.
+
+fetchHeaders gets only the JPEG headers of a remote image by HTTP range
+requests, e.g. to read its metadata without downloading the image."""
+
+import os
+import time
+import hashlib
+import urllib2
+import urlparse
+import tempfile
+import threading
+import jpeg_metadata
+from osm_map.lib import urllib3
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+HEADER_FETCH_SIZE = 64*1024 #: bytes of the first range request, usually covers all headers
+MAX_HEADER_SIZE = 1024*1024 #: bytes searched for the end of JPEG headers
+
+
+def fetchHeaders(url, http=None, timeout=30, size=HEADER_FETCH_SIZE, complete=True):
+    """Returns the start of the JPEG file at url up to the end of its headers,
+    fetched by HTTP range requests for growing prefixes. If the server does
+    not support ranges, only the prefix of its full response is read.
+
+    @param http: urllib3.PoolManager, to reuse its connections
+    @param size: bytes of the first request, grows by factor 4
+    @param complete: if the header reader cannot handle the file, return
+                     the whole file for the caller's fallback instead of
+                     raising the JpegHeaderError
+    @raise IOError: if the request fails or the file ends within the headers"""
+    if http is None:
+        http = urllib3.PoolManager()
+    def _request(start, end=''):
+        """Returns the response to a range request, None if the range starts behind the end of file"""
+        r = http.request('GET', url, headers={'Range': 'bytes=%i-%s' % (start, end)},
+                         timeout=timeout, preload_content=False)
+        if r.status == 206 or r.status == 200:
+            return r
+        discardResponse(r)
+        if r.status != 416:
+            raise IOError('Could not fetch %s: HTTP status %i' % (url, r.status))
+        return None
+    data = ''
+    response = None #: full response of a server without range support
+    try:
+        while True:
+            try:
+                if response is None:
+                    r = _request(len(data), size-1)
+                    if r is not None and r.status == 206:
+                        data += r.read()
+                        r.release_conn()
+                    elif r is not None:
+                        response = r
+                        data = response.read(size)
+                else:
+                    data += response.read(size - len(data))
+            except urllib3.exceptions.HTTPError as strerror:
+                raise IOError('Could not fetch %s: %s' % (url, strerror))
+            try:
+                jpeg_metadata.JpegHeaderMetadata.from_buffer(data)
+            except jpeg_metadata.JpegTruncatedError:
+                if len(data) < size:
+                    raise IOError('%s ends within its JPEG headers' % url)
+                if size >= MAX_HEADER_SIZE:
+                    raise IOError('JPEG headers of %s exceed %i bytes' % (url, MAX_HEADER_SIZE))
+                size *= 4
+                continue
+            except jpeg_metadata.JpegHeaderError:
+                if not complete:
+                    raise
+                # the fallback reads the whole file
+                try:
+                    if response is not None:
+                        data += response.read()
+                    elif len(data) >= size:
+                        r = _request(len(data))
+                        if r is not None:
+                            data = data + r.read() if r.status == 206 else r.read()
+                            r.release_conn()
+                except urllib3.exceptions.HTTPError as strerror:
+                    raise IOError('Could not fetch %s: %s' % (url, strerror))
+            return data
+    finally:
+        if response is not None:
+            discardResponse(response)
+
+
+def replaceFile(src, dst):
+    """Renames file src to dst, replacing dst if it exists"""
+    if os.name == 'nt' and os.path.exists(dst):
+        # rename does not replace files on Windows
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def discardResponse(response):
+    """Closes the connection of a urllib3 response whose body is not read
+    completely and returns it to its pool, which reconnects on next use"""
+    if response._original_response is not None:
+        response._original_response.close()
+    if response._connection is not None:
+        response._connection.close()
+    response.release_conn()
+
+
+class Download(threading.Thread):
+    """Downloads url to path or into a DownloadCache in a background thread"""
+
+    CHUNK_SIZE = 64*1024 #: bytes read and written at once
+    TIMEOUT = 30 #: seconds without data after which the download fails
+    PROGRESS_INTERVAL = 0.1 #: minimum seconds between progress reports
+
+    def __init__(self, url, path, progress=None, header=None, done=None, cache=None):
+        """Callbacks are called in the download thread.
+
+        @param path: destination, ignored if cache is given
+        @param cache: download_cache.DownloadCache to revalidate and store url in,
+                      the done callback gets the path of the body in the cache
+        @param progress: function(received bytes, total bytes or None)
+        @param header: function(data) called once with the start of the body
+                       as soon as it contains the complete JPEG headers
+        @param done: function(path, error), error is None on success"""
+        super(Download, self).__init__(name='download')
+        self.daemon = True
+        self.url = url
+        self.path = path
+        self.progress = progress
+        self.header = header
+        self.done = done
+        self.cache = cache
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.download()
+        except Exception as strerror:
+            # also errors of callbacks and the cache, done must be called in any case
+            if self.done is not None and not self.cancelled:
+                self.done(self.path, strerror)
+            return
+        if self.done is not None and not self.cancelled:
+            self.done(self.path, None)
+
+    def download(self):
+        request = urllib2.Request(self.url)
+        if self.cache is not None:
+            for name, value in self.cache.validators(self.url).iteritems():
+                request.add_header(name, value)
+        try:
+            response = urllib2.urlopen(request, timeout=self.TIMEOUT)
+        except urllib2.HTTPError as error:
+            if error.code == 304 and self.cache is not None:
+                # not modified, no body sent
+                self.path = self.cache.revalidated(self.url)
+                if self.path is not None:
+                    return
+            raise
+        try:
+            total = response.info().getheader('Content-Length')
+            total = int(total) if total is not None and total.isdigit() else None
+            dir = self.cache.dir if self.cache is not None else os.path.dirname(self.path) or '.'
+            fd, temp = tempfile.mkstemp(prefix='.download-', dir=dir)
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    hash = self.stream(response, f, total)
+                finally:
+                    f.close()
+                if self.cancelled:
+                    raise IOError('download cancelled')
+                if self.cache is not None:
+                    extension = os.path.splitext(urlparse.urlsplit(self.url).path)[1].lower()
+                    self.path = self.cache.store(self.url, temp, hash, response.info().getheader('ETag'),
+                                                 response.info().getheader('Last-Modified'), extension)
+                    return
+                replaceFile(temp, self.path)
+            except:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+        finally:
+            response.close()
+
+    def stream(self, response, f, total):
+        """Copies the response body to file f chunk by chunk, returns its SHA-1 hex digest"""
+        hash = hashlib.sha1()
+        received = 0
+        lastprogress = 0
+        prefix = '' if self.header is not None else None #: body start searched for JPEG headers
+        while not self.cancelled:
+            chunk = response.read(self.CHUNK_SIZE)
+            if chunk == '':
+                break
+            f.write(chunk)
+            hash.update(chunk)
+            received += len(chunk)
+            if prefix is not None:
+                prefix += chunk
+                prefix = self.checkHeader(prefix)
+            if self.progress is not None and time.time() - lastprogress >= self.PROGRESS_INTERVAL:
+                self.progress(received, total)
+                lastprogress = time.time()
+        if total is not None and received < total and not self.cancelled:
+            raise IOError('download incomplete: %i of %i bytes' % (received, total))
+        if self.progress is not None:
+            self.progress(received, total)
+        return hash.hexdigest()
+
+    def checkHeader(self, prefix):
+        """Calls the header callback if prefix contains the complete JPEG headers,
+        returns the prefix to search further or None to stop searching"""
+        try:
+            jpeg_metadata.JpegHeaderMetadata.from_buffer(prefix)
+        except jpeg_metadata.JpegTruncatedError:
+            return prefix if len(prefix) < MAX_HEADER_SIZE else None
+        except jpeg_metadata.JpegHeaderError:
+            # no JPEG or headers the reader cannot handle
+            return None
+        self.header(prefix)
+        return None
+
+    def cancel(self):
+        """Stops the download, no further callbacks are made"""
+        self.cancelled = True
+
+
+def testServer(dir, ranges=True, etags=False):
+    """Starts a local stand-in HTTP server for tests serving the files in dir
+    by name, whatever the URL's directory. Returns the server, its attributes
+    ranges and etags switch the features, statuses lists the answers sent.
+
+    @param ranges: answer range requests with 206 Partial Content
+    @param etags: send ETags, answer 304 Not Modified to matching If-None-Match"""
+    import urllib
+    import BaseHTTPServer
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            server = self.server
+            path = os.path.join(server.dir, urllib.unquote(os.path.basename(self.path)))
+            etag = '"%x"' % os.stat(path).st_mtime
+            if server.etags and self.headers.getheader('If-None-Match') == etag:
+                self.respond(304, None)
+                return
+            body = open(path, 'rb').read()
+            range = self.headers.getheader('Range')
+            if server.ranges and range is not None:
+                start, end = [int(x) for x in range[len('bytes='):].split('-')]
+                if start >= len(body):
+                    self.respond(416, '')
+                    return
+                part = body[start:end+1]
+                self.respond(206, part, { 'Content-Range': 'bytes %i-%i/%i' % (start, start+len(part)-1, len(body)) })
+            else:
+                self.respond(200, body, { 'ETag': etag } if server.etags else {})
+        def respond(self, status, body, headers={}):
+            self.server.statuses.append(status)
+            self.send_response(status)
+            for name, value in headers.iteritems():
+                self.send_header(name, value)
+            if body is not None:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.dir = dir
+    server.ranges = ranges
+    server.etags = etags
+    server.statuses = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test():
+    """Fetches the headers of the sample images from a local stand-in HTTP server,
+    with and without range support"""
+    import urllib
+    dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_images')
+    server = testServer(dir)
+    http = urllib3.PoolManager()
+    for ranges, size in ((True, HEADER_FETCH_SIZE), (True, 1024), (False, 1024)):
+        server.ranges = ranges
+        for filename in sorted(os.listdir(dir)):
+            if not filename.lower().endswith('.jpg'):
+                continue
+            data = fetchHeaders('http://127.0.0.1:%i/%s' % (server.server_port, urllib.quote(filename)), http, size=size)
+            original = open(os.path.join(dir, filename), 'rb').read()
+            assert original.startswith(data)
+            jpeg_metadata.JpegHeaderMetadata.from_buffer(data)
+            print '%s (ranges: %s, first %i bytes): %i of %i bytes' % (filename, ranges, size, len(data), len(original))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""Persistent cache of downloaded files, keyed by URL
+
+Bodies are stored once per content hash, so URLs of the same file share
+it. For each URL the ETag and Last-Modified validators are kept, repeated
+downloads send them and reuse the stored body if the server answers 304
+Not Modified. The cache is bounded in size, least recently used bodies
+are evicted first."""
+
+import os
+import time
+import download
+from sqlite_cache import SQLiteCache
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class DownloadCache(SQLiteCache):
+    """Stores downloaded bodies by content hash in a directory"""
+
+    SCHEMA_VERSION = 1 #: increase on changes of tables or stored data
+    INDEX = 'index.sqlite' #: filename of the index database in the cache directory
+    TABLES = { 'urls': 'url TEXT PRIMARY KEY, hash TEXT, etag TEXT, lastmodified TEXT',
+               'bodies': 'hash TEXT PRIMARY KEY, filename TEXT, size INTEGER, used REAL' }
+    INDEXES = { 'urls_hash': ('urls', 'hash'), 'bodies_used': ('bodies', 'used') }
+    TABLE = 'bodies'
+    KEY = 'hash'
+    SIZE = 'size'
+
+    def __init__(self, dir, maxsize=512*1024*1024):
+        """@param dir: directory of bodies and index, created if needed
+           @param maxsize: maximum size of stored bodies in bytes"""
+        self.dir = dir
+        super(DownloadCache, self).__init__(os.path.join(dir, self.INDEX), maxsize)
+
+    def lookup(self, url):
+        """Returns (path of the stored body, ETag, Last-Modified) of url or None if not cached"""
+        with self.lock:
+            row = self.db.execute('SELECT bodies.filename, urls.etag, urls.lastmodified FROM urls '
+                                  'JOIN bodies ON urls.hash = bodies.hash WHERE urls.url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(self.dir, row[0])
+            if not os.path.isfile(path):
+                self.db.execute('DELETE FROM urls WHERE url = ?', (url,))
+                self.commit()
+                return None
+            return (path, row[1], row[2])
+
+    def validators(self, url):
+        """Returns the conditional request headers for url, empty if not cached"""
+        entry = self.lookup(url)
+        headers = {}
+        if entry is not None:
+            if entry[1] is not None:
+                headers['If-None-Match'] = entry[1]
+            if entry[2] is not None:
+                headers['If-Modified-Since'] = entry[2]
+        return headers
+
+    def revalidated(self, url):
+        """Marks the body of url as used after the server answered 304, returns its path"""
+        with self.lock:
+            entry = self.lookup(url)
+            if entry is None:
+                return None
+            self.db.execute('UPDATE bodies SET used = ? WHERE hash = (SELECT hash FROM urls WHERE url = ?)',
+                            (time.time(), url))
+            self.commit()
+            return entry[0]
+
+    def store(self, url, temp, hash, etag=None, lastmodified=None, extension=''):
+        """Moves the downloaded file temp into the cache as body of url, returns its path
+
+        @param hash: hex digest of the file's content
+        @param extension: filename extension of the body, e.g. '.jpg'"""
+        filename = hash + extension
+        path = os.path.join(self.dir, filename)
+        size = os.path.getsize(temp)
+        with self.lock:
+            row = self.db.execute('SELECT filename, size FROM bodies WHERE hash = ?', (hash,)).fetchone()
+            if row is not None and os.path.isfile(os.path.join(self.dir, row[0])):
+                # same content stored already
+                os.remove(temp)
+                path = os.path.join(self.dir, row[0])
+                self.db.execute('UPDATE bodies SET used = ? WHERE hash = ?', (time.time(), hash))
+            else:
+                download.replaceFile(temp, path)
+                if row is not None:
+                    self.totalsize -= row[1]
+                self.db.execute('INSERT OR REPLACE INTO bodies VALUES (?, ?, ?, ?)', (hash, filename, size, time.time()))
+                self.totalsize += size
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)', (url, hash, etag, lastmodified))
+            if self.totalsize > self.maxsize:
+                self.evict(self.maxsize * 9 / 10, keep=hash)
+            self.commit()
+        return path
+
+    def schemaReset(self):
+        """Deletes the bodies stored under an outdated schema, no row refers to them anymore"""
+        for filename in os.listdir(self.dir):
+            path = os.path.join(self.dir, filename)
+            if filename.startswith(self.INDEX) or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evicted(self, keys):
+        """Deletes the files of evicted bodies and the URLs stored as them"""
+        for hash, in keys:
+            filename = self.db.execute('SELECT filename FROM bodies WHERE hash = ?', (hash,)).fetchone()[0]
+            try:
+                os.remove(os.path.join(self.dir, filename))
+            except OSError:
+                pass
+        self.db.executemany('DELETE FROM urls WHERE hash = ?', keys)
+
+    def __len__(self):
+        """Returns the number of URLs cached"""
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+
+
+def test():
+    """Downloads the sample images twice from a local stand-in HTTP server
+    answering conditional requests, and under two URLs each"""
+    import urllib
+    import shutil
+    import tempfile
+    dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_images')
+    server = download.testServer(dir, ranges=False, etags=True)
+    cachedir = tempfile.mkdtemp()
+    try:
+        cache = DownloadCache(cachedir)
+        filenames = sorted(f for f in os.listdir(dir) if f.lower().endswith('.jpg'))
+        for prefix in ('a', 'b', 'a'):
+            for filename in filenames:
+                url = 'http://127.0.0.1:%i/%s/%s' % (server.server_port, prefix, urllib.quote(filename))
+                d = download.Download(url, None, cache=cache)
+                d.run()
+                assert open(d.path, 'rb').read() == open(os.path.join(dir, filename), 'rb').read()
+        n = len(filenames)
+        assert server.statuses == [200]*2*n + [304]*n
+        assert len(cache) == 2*n
+        assert len([f for f in os.listdir(cachedir) if not f.startswith(DownloadCache.INDEX)]) == n
+        print '%i URLs of %i files cached in %i bytes, %i revalidated' % (len(cache), n, cache.totalsize, n)
+        cache.evict(cache.totalsize / 2)
+        cache.commit()
+        print 'evicted to %i bytes, %i URLs left' % (cache.totalsize, len(cache))
+        cache.close()
+    finally:
+        server.shutdown()
+        shutil.rmtree(cachedir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""Header-only JPEG metadata reader
+
+Scans the JPEG markers up to the start of scan (SOS) and reads the Exif
+GPS IFD and the XMP packet from the APP1 segments, without touching the
+image data. The image size from the SOF segment and the Exif thumbnail
+are kept as well, e.g. for previews. The result offers the subset of the pyexiv2.ImageMetadata
+interface the private metadata parsers use, so they run unchanged on it.
+Anything this reader cannot handle raises a JpegHeaderError, callers
+should fall back to pyexiv2 then."""
+
+import re
+import struct
+import StringIO
+from fractions import Fraction
+from xml.etree import ElementTree as ET
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class JpegHeaderError(Exception):
+    """The header reader cannot handle this file"""
+    pass
+
+
+class JpegTruncatedError(JpegHeaderError):
+    """The file ends within the headers, e.g. it is partially downloaded"""
+    pass
+
+
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+XML = '{http://www.w3.org/XML/1998/namespace}'
+
+#: exiv2's prefixes of namespaces, used for keys regardless of document prefixes
+XMP_PREFIXES = { 'http://purl.org/dc/elements/1.1/': 'dc',
+                 'http://ns.adobe.com/xap/1.0/': 'xmp',
+                 'http://ns.adobe.com/xap/1.0/mm/': 'xmpMM',
+                 'http://ns.adobe.com/photoshop/1.0/': 'photoshop',
+                 'http://www.metadataworkinggroup.com/schemas/regions/': 'mwg-rs',
+                 'http://ns.adobe.com/xmp/sType/Area#': 'stArea',
+                 'http://ns.adobe.com/xap/1.0/sType/Dimensions#': 'stDim',
+                 'http://ns.microsoft.com/photo/1.2/': 'MP',
+                 'http://ns.microsoft.com/photo/1.2/t/RegionInfo#': 'MPRI',
+                 'http://ns.microsoft.com/photo/1.2/t/Region#': 'MPReg',
+                 'http://ns.iview-multimedia.com/mediapro/1.0/': 'mediapro',
+                 'http://iptc.org/std/Iptc4xmpExt/2008-02-29/': 'iptcExt',
+               }
+
+#: Exif GPS IFD tags we read: tag -> key
+GPS_TAGS = { 1: 'Exif.GPSInfo.GPSLatitudeRef',
+             2: 'Exif.GPSInfo.GPSLatitude',
+             3: 'Exif.GPSInfo.GPSLongitudeRef',
+             4: 'Exif.GPSInfo.GPSLongitude',
+             5: 'Exif.GPSInfo.GPSAltitudeRef',
+             6: 'Exif.GPSInfo.GPSAltitude',
+             11: 'Exif.GPSInfo.GPSDOP',
+           }
+GPS_IFD_POINTER = 0x8825
+THUMBNAIL_OFFSET = 0x0201 #: JPEGInterchangeFormat in IFD1
+THUMBNAIL_LENGTH = 0x0202 #: JPEGInterchangeFormatLength in IFD1
+SOF_MARKERS = '\xc0\xc1\xc2\xc3\xc5\xc6\xc7\xc9\xca\xcb\xcd\xce\xcf'
+EXIF_HEADER = 'Exif\x00\x00'
+XMP_HEADER = 'http://ns.adobe.com/xap/1.0/\x00'
+XMP_EXTENSION_HEADER = 'http://ns.adobe.com/xmp/extension/\x00'
+
+
+class HeaderTag(object):
+    """A metadata tag with value and raw_value as pyexiv2 tags provide"""
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.raw_value = value
+    def __repr__(self):
+        return '<%s = %r>' % (self.key, self.value)
+
+
+class JpegHeaderMetadata(dict):
+    """Exif GPS and XMP metadata read from the JPEG headers only"""
+
+    def __init__(self):
+        super(JpegHeaderMetadata, self).__init__()
+        self.exif_keys = []
+        self.iptc_keys = []
+        self.xmp_keys = []
+        self.dimensions = None #: (width, height) of the image from its SOF segment
+        self.thumbnail = None #: JPEG data of the Exif thumbnail
+
+    @classmethod
+    def from_file(cls, filename):
+        f = open(filename, 'rb')
+        try:
+            return cls.from_stream(f)
+        finally:
+            f.close()
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        return cls.from_stream(StringIO.StringIO(buffer))
+
+    @classmethod
+    def from_stream(cls, f):
+        md = cls()
+        md.read(f)
+        return md
+
+    def add(self, key, value):
+        # dict's own membership test, subclasses may emulate pyexiv2's slower one
+        if not dict.__contains__(self, key):
+            if key.startswith('Xmp.'):
+                self.xmp_keys.append(key)
+            elif key.startswith('Exif.'):
+                self.exif_keys.append(key)
+            else:
+                self.iptc_keys.append(key)
+        self[key] = HeaderTag(key, value)
+
+    def keys(self):
+        return self.exif_keys + self.iptc_keys + self.xmp_keys
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def read(self, f):
+        """Reads APP1 segments from file object f, stops at SOS"""
+        if f.read(2) != '\xff\xd8':
+            raise JpegHeaderError('not a JPEG file')
+        while True:
+            b = f.read(1)
+            if b == '':
+                raise JpegTruncatedError('unexpected end of file')
+            if b != '\xff':
+                raise JpegHeaderError('marker expected')
+            marker = f.read(1)
+            while marker == '\xff':
+                # fill bytes
+                marker = f.read(1)
+            if marker == '':
+                raise JpegTruncatedError('unexpected end of file')
+            if marker == '\xda' or marker == '\xd9':
+                # SOS or EOI: no more metadata ahead
+                return
+            if marker == '\x01' or '\xd0' <= marker <= '\xd7':
+                # standalone markers without a length
+                continue
+            l = f.read(2)
+            if len(l) != 2:
+                raise JpegTruncatedError('unexpected end of file')
+            length = struct.unpack('>H', l)[0] - 2
+            if length < 0:
+                raise JpegHeaderError('invalid segment length')
+            if marker == '\xe1':
+                segment = f.read(length)
+                if len(segment) != length:
+                    raise JpegTruncatedError('unexpected end of file')
+                if segment.startswith(EXIF_HEADER):
+                    self.parseExif(segment[len(EXIF_HEADER):])
+                elif segment.startswith(XMP_HEADER):
+                    self.parseXmp(segment[len(XMP_HEADER):])
+                elif segment.startswith(XMP_EXTENSION_HEADER):
+                    raise JpegHeaderError('extended XMP is not supported')
+            elif marker in SOF_MARKERS and length >= 5:
+                segment = f.read(5)
+                if len(segment) != 5:
+                    raise JpegTruncatedError('unexpected end of file')
+                height, width = struct.unpack('>HH', segment[1:5])
+                self.dimensions = (width, height)
+                f.seek(length - 5, 1)
+            else:
+                f.seek(length, 1)
+
+    def parseExif(self, tiff):
+        """Reads the GPS IFD and the thumbnail from a TIFF structure"""
+        if len(tiff) < 8:
+            raise JpegHeaderError('truncated TIFF header')
+        if tiff[0:2] == 'II':
+            bo = '<'
+        elif tiff[0:2] == 'MM':
+            bo = '>'
+        else:
+            raise JpegHeaderError('invalid TIFF byte order')
+        def _ifd(offset):
+            try:
+                n = struct.unpack(bo+'H', tiff[offset:offset+2])[0]
+                return [struct.unpack(bo+'HHI4s', tiff[offset+2+12*i:offset+14+12*i]) for i in xrange(n)]
+            except struct.error:
+                raise JpegHeaderError('truncated IFD')
+        gpsifd = None
+        ifd0 = struct.unpack(bo+'I', tiff[4:8])[0]
+        entries = _ifd(ifd0)
+        for tag, type, count, data in entries:
+            if tag == GPS_IFD_POINTER:
+                gpsifd = struct.unpack(bo+'I', data)[0]
+        # thumbnail in IFD1, ignored if malformed
+        try:
+            ifd1 = struct.unpack(bo+'I', tiff[ifd0+2+12*len(entries):ifd0+6+12*len(entries)])[0]
+            if ifd1 != 0:
+                thumbnail = dict((tag, struct.unpack(bo+'I', data)[0]) for tag, type, count, data in _ifd(ifd1)
+                                 if tag in (THUMBNAIL_OFFSET, THUMBNAIL_LENGTH))
+                if len(thumbnail) == 2:
+                    data = tiff[thumbnail[THUMBNAIL_OFFSET]:thumbnail[THUMBNAIL_OFFSET]+thumbnail[THUMBNAIL_LENGTH]]
+                    if data.startswith('\xff\xd8'):
+                        self.thumbnail = data
+        except (struct.error, JpegHeaderError):
+            pass
+        if gpsifd is None:
+            return
+        for tag, type, count, data in _ifd(gpsifd):
+            if tag not in GPS_TAGS:
+                continue
+            if type == 2:
+                # ASCII
+                if count > 4:
+                    offset = struct.unpack(bo+'I', data)[0]
+                    data = tiff[offset:offset+count]
+                self.add(GPS_TAGS[tag], data[:count].split('\x00')[0])
+            elif type == 1 and count == 1:
+                # BYTE
+                self.add(GPS_TAGS[tag], ord(data[0]))
+            elif type == 5:
+                # RATIONAL, always stored at an offset
+                offset = struct.unpack(bo+'I', data)[0]
+                values = []
+                for i in xrange(count):
+                    try:
+                        num, den = struct.unpack(bo+'II', tiff[offset+8*i:offset+8*i+8])
+                    except struct.error:
+                        raise JpegHeaderError('truncated rational')
+                    values.append(Fraction(num, den) if den != 0 else Fraction(0))
+                self.add(GPS_TAGS[tag], values if count > 1 else values[0])
+            else:
+                raise JpegHeaderError('unexpected type %i of GPS tag %i' % (type, tag))
+
+    def parseXmp(self, packet):
+        """Flattens an XMP packet to exiv2 style keys"""
+        prefixes = dict((uri, prefix) for prefix, uri in re.findall(r'xmlns:([\w.-]+)\s*=\s*["\']([^"\']*)["\']', packet))
+        prefixes.update(XMP_PREFIXES)
+        def _qname(tag):
+            if not tag.startswith('{'):
+                raise JpegHeaderError('XMP property without namespace: %s' % tag)
+            uri, local = tag[1:].split('}', 1)
+            if uri not in prefixes:
+                raise JpegHeaderError('unknown XMP namespace: %s' % uri)
+            return prefixes[uri], local
+        def _fields(element):
+            """struct fields as (tag, value or element), from attributes and children"""
+            fields = [(k, v) for k, v in element.attrib.items() if not (k.startswith(RDF) or k.startswith(XML))]
+            for child in element:
+                if child.tag == RDF+'Description':
+                    fields += _fields(child)
+                else:
+                    fields.append((child.tag, child))
+            return fields
+        def _isstruct(element):
+            if element.get(RDF+'parseType') == 'Resource':
+                return True
+            return len(_fields(element)) > 0
+        def _value(path, element):
+            if not ET.iselement(element):
+                self.add(path, element)
+                return
+            children = list(element)
+            if len(children) == 1 and children[0].tag in (RDF+'Bag', RDF+'Seq', RDF+'Alt'):
+                items = children[0].findall(RDF+'li')
+                if children[0].tag == RDF+'Alt':
+                    self.add(path, dict((li.get(XML+'lang', 'x-default'), li.text or '') for li in items))
+                elif [li for li in items if _isstruct(li)]:
+                    self.add(path, '')
+                    for i, li in enumerate(items):
+                        _value('%s[%i]' % (path, i+1), li)
+                else:
+                    self.add(path, [li.text or '' for li in items])
+            elif _isstruct(element):
+                self.add(path, '')
+                for tag, value in _fields(element):
+                    _value('%s/%s:%s' % ((path,) + _qname(tag)), value)
+            else:
+                self.add(path, element.text or '')
+        if '<!DOCTYPE' in packet or '<!ENTITY' in packet:
+            # entity expansion could blow up, XMP has no use for DTDs
+            raise JpegHeaderError('XMP packet with DTD')
+        try:
+            root = ET.fromstring(packet.rstrip('\x00 \t\r\n'))
+        except Exception as e:
+            raise JpegHeaderError('malformed XMP packet: %s' % e)
+        rdf =root if root.tag == RDF+'RDF' else root.find(RDF+'RDF')
+        if rdf is None:
+            raise JpegHeaderError('XMP packet without rdf:RDF')
+        for description in rdf.findall(RDF+'Description'):
+            for tag, value in _fields(description):
+                _value('Xmp.%s.%s' % _qname(tag), value)
+
+
+def test():
+    import sys
+    for filename in sys.argv[1:]:
+        md = JpegHeaderMetadata.from_file(filename)
+        print filename, md.dimensions, 'thumbnail: %s bytes' % (len(md.thumbnail) if md.thumbnail else None)
+        for k, v in md.iteritems():
+            print ' %s: %r' % (k, v.value)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Streaming enumeration of JPEG files in a background thread
+
+Uses scandir (os.scandir or the scandir package for Python 2), whose
+directory entries know their type without an extra stat call on most
+platforms. Falls back to os.listdir and os.walk if it is not available."""
+
+import os
+import time
+import threading
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None #: optional, without it every entry is stat()ed while walking trees
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+def isJpg(name):
+    return name.lower().endswith('.jpg')
+
+
+def iterJpgs(dir, recursive=False):
+    """Yields the paths of the JPEG files in dir, and in the directories
+    below it if recursive, in directory order. Symlinked directories are
+    not followed, as with os.walk."""
+    if scandir is None:
+        if recursive == False:
+            for file in os.listdir(dir):
+                if isJpg(file):
+                    yield os.path.join(dir, file)
+        else:
+            for path, paths, files in os.walk(dir):
+                for file in files:
+                    if isJpg(file):
+                        yield os.path.join(path, file)
+        return
+    stack = [dir]
+    while stack:
+        try:
+            entries = scandir(stack.pop())
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if recursive == False:
+                if isJpg(entry.name):
+                    yield entry.path
+                continue
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif isJpg(entry.name):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+class JpgScanner(threading.Thread):
+    """Enumerates the JPEG files of a directory in a background thread
+
+    Reports the sorted list of all files found so far: at once for the
+    first file, then every FLUSH_INTERVAL seconds, and when finished."""
+
+    FLUSH_INTERVAL = 0.5 #: seconds between reports
+
+    def __init__(self, dir, recursive, found):
+        """@param found: function(paths, finished) called in the scanner thread
+                         with a new sorted list of all paths found so far"""
+        super(JpgScanner, self).__init__(name='jpgscanner')
+        self.daemon = True
+        self.dir = dir
+        self.recursive = recursive
+        self.found = found
+        self.cancelled = False
+
+    def run(self):
+        paths = []
+        lastflush = time.time()
+        if os.path.isdir(self.dir):
+            for path in iterJpgs(self.dir, self.recursive):
+                if self.cancelled:
+                    return
+                paths.append(path)
+                if len(paths) == 1 or time.time() - lastflush >= self.FLUSH_INTERVAL:
+                    # sorting appended runs is cheap for timsort
+                    paths.sort()
+                    self.found(list(paths), False)
+                    lastflush = time.time()
+        if not self.cancelled:
+            paths.sort()
+            self.found(paths, True)
+
+    def cancel(self):
+        """Stops the scan, no further reports are made"""
+        self.cancelled = True
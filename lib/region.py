@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Image region (person/face tag) records shared by all region sources"""
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class Region(object):
+    """A tagged image region
+
+    Coordinates are normalized to 0..1 of image width/height, left/top is
+    the upper left corner. Regions without area have None coordinates,
+    points have width and height 0, circles have width = height = diameter
+    and the circle's bounding box as left/top."""
+
+    # area flags
+    ANYWHERE = 0
+    POINT = 1
+    CIRCLE = 2
+    RECTANGLE = 4
+    # type flags
+    FACE = 8
+    PET = 16
+    FOCUS = 32
+    BARCODE = 64
+    UNKNOWN = 1024
+
+    __slots__ = ('type', 'name', 'source', 'left', 'top', 'width', 'height')
+
+    def __init__(self, type, name, source, left=None, top=None, width=None, height=None):
+        """@param type: area and type flags, e.g. Region.FACE | Region.RECTANGLE
+           @param name: name of the person or region
+           @param source: metadata the region was read from, e.g. 'mwg-rs'"""
+        self.type = type
+        self.name = name
+        self.source = source
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def fromCenter(cls, type, name, source, x, y, width, height):
+        return cls(type, name, source, x - width / 2, y - height / 2, width, height)
+
+    def hasArea(self):
+        return self.left is not None
+
+    def astuple(self):
+        """Returns the region as tuple of builtin types, e.g. for storage"""
+        return (self.type, self.name, self.source, self.left, self.top, self.width, self.height)
+
+    @classmethod
+    def fromtuple(cls, t):
+        return cls(*t)
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and self.astuple() == other.astuple()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __lt__(self, other):
+        return self.astuple() < other.astuple()
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        if self.hasArea():
+            return 'Region(%i, %r, %s, %0.5f, %0.5f, %0.5f, %0.5f)' % self.astuple()
+        return 'Region(%i, %r, %s)' % self.astuple()[0:3]
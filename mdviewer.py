@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 
-import sys, os
-import pyexiv2, private_metadata
+import sys, os, time, threading, cStringIO, bisect
+import pyexiv2, private_metadata, metadata_cache, jpeg_metadata, prefetch, download, download_cache
 import picasa_faces.picasa_faces
 import wx
 from lib.proportionalsplitter import ProportionalSplitter
+from lib.region import Region
+from lib.jpgscanner import JpgScanner
 from osm_map.map_viewer import MapPanel
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    try:
+        import Image as PILImage
+    except ImportError:
+        PILImage = None #: optional, without PIL JPEGs are decoded in full resolution
 
 __author__ = "B. Henne"
 __contact__ = "henne@dcsec.uni-hannover.de"
@@ -21,53 +30,241 @@ def unifix(any):
     except:
         return unicode(any, errors='replace')
 
+def embeddedPreview(header, md=None):
+    """Returns (JPEG data, (width, height) of the full image) of the largest
+    preview embedded in a JPEG file, or None if it has none
+
+    @param header: JpegHeaderMetadata of the file, None if it could not be read
+    @param md: PrivateMetadata of the file, its previews are used if it was read by pyexiv2"""
+    if header is None or header.dimensions is None:
+        return None
+    data = header.thumbnail
+    if isinstance(md, private_metadata.PrivateMetadata) and md.backend == 'pyexiv2':
+        previews = md.previews # sorted by increasing size
+        if len(previews) > 0:
+            data = previews[-1].data
+    if data is None:
+        return None
+    return data, header.dimensions
+
 class ImagePanel(wx.Panel):
+    COLOURS = { 'picasa.ini': 'blue', 'mp-ri': 'red', 'mwg-rs': 'green' } #: region colours by source
+    POINT_SIZE = 0.04 #: normalized size of the square drawn for point regions
+    RESIZE_IDLE = 200 #: ms without size change after which a resize is finished
+    PROFILE = os.getenv('MDVIEWER_PROFILE') is not None #: print frame times
+
     def __init__(self, parent, *args, **kwargs):
         wx.Panel.__init__(self, parent, *args, **kwargs)
         self.SetBackgroundColour("Light Grey")
-        placeholder = (wx.EmptyImage(*self.GetSize()))
-        placeholder.ConvertColourToAlpha(0,0,0)
-        self.setImage(placeholder)
+        self.resizing = False
+        self.resizeTimer = wx.PyTimer(self.OnResizeDone)
+        self.frameTimes = { 'fast': [0, 0.0], 'high': [0, 0.0] } #: mode -> [frames, total seconds]
+        self.generation = 0 #: increased with every image set, outdated decodes are dropped
+        self.decoding = False #: an image is decoded by loadImageAsync
+        self.decodeFailed = None #: path of the image that could not be decoded, not retried
+        self.decodedCallback = None #: callback of loadImageAsync for decodes of the image shown
+        self.showPlaceholder()
         self.Bind(wx.EVT_SIZE, self.OnSize)
         self.Bind(wx.EVT_PAINT, self.OnPaint)
         self.SetFocus()
 
     def OnSize(self, e):
+        # draw fast while the size changes, in high quality once it is stable
+        self.resizing = True
+        self.resizeTimer.Start(self.RESIZE_IDLE, wx.TIMER_ONE_SHOT)
+        self.Refresh()
+
+    def OnResizeDone(self):
+        self.resizing = False
         self.Refresh()
 
     def OnPaint(self, e):
+        start = time.time()
+        mode = 'fast' if self.resizing else 'high'
         panelw, panelh = self.GetClientSize()
-        minsize = self.GetMinSize()
-        minfactor = min(1.0*minsize[0]/self.w,1.0*minsize[1]/self.h)
-        factor = max(minfactor, min(1.0*panelw/self.w, 1.0*panelh/self.h, 1.0))
-        bmp = self.image.Scale(self.w*factor, self.h*factor, quality=wx.IMAGE_QUALITY_HIGH).ConvertToBitmap()
+        factor = self.displayFactor()
+        if not self.resizing and not self.decoding and self.imagePath is not None and \
+           self.imagePath != self.decodeFailed and self.image.GetWidth() < self.w and \
+           (int(self.w*factor) > self.image.GetWidth() or int(self.h*factor) > self.image.GetHeight()):
+            # panel grew beyond the reduced resolution decoded, the current image is painted until decoded again
+            self.loadImageAsync(self.imagePath, callback=self.decodedCallback)
+        bmp = self.scaledBitmap(int(self.w*factor), int(self.h*factor), fast=self.resizing)
         posx, posy = (panelw - self.w*factor)/2, (panelh - self.h*factor)/2  
         dc = wx.AutoBufferedPaintDCFactory(self)
         dc.Clear()
         dc.DrawBitmap(bmp, posx, posy, True)
-        if self.rects is not None:
+        if self.regions is not None:
             dc.SetBrush(wx.TRANSPARENT_BRUSH)
-            for r in self.rects:
-                dc.SetPen(wx.Pen(r[5], 2, wx.SOLID))
-                left = int((r[1])*self.w*factor)+posx
-                top = int((r[2])*self.h*factor)+posy
-                dc.DrawRectangle(left, top, int(r[3]*self.w*factor), int(r[4]*self.h*factor))
-                dc.SetTextForeground(r[5])
-                dc.DrawText(r[0].replace(" ", "\n"), left, top)
+            for r in self.regions:
+                if not r.hasArea():
+                    continue
+                rleft, rtop, rwidth, rheight = r.left, r.top, r.width, r.height
+                if r.type & Region.POINT:
+                    d = self.POINT_SIZE
+                    rleft, rtop, rwidth, rheight = rleft-d/2, rtop-d/2, d, d
+                colour = self.COLOURS.get(r.source, 'black')
+                dc.SetPen(wx.Pen(colour, 2, wx.SOLID))
+                left = int(rleft*self.w*factor)+posx
+                top = int(rtop*self.h*factor)+posy
+                dc.DrawRectangle(left, top, int(rwidth*self.w*factor), int(rheight*self.h*factor))
+                dc.SetTextForeground(colour)
+                dc.DrawText(r.name.replace(" ", "\n"), left, top)
         del dc
+        frametime = time.time() - start
+        self.frameTimes[mode][0] += 1
+        self.frameTimes[mode][1] += frametime
+        if self.PROFILE:
+            print 'ImagePanel frame (%s quality): %.1f ms' % (mode, frametime * 1000)
+
+    def displayFactor(self):
+        """Returns the factor from full image size to displayed size"""
+        return self.fitFactor(self.w, self.h, self.GetClientSize(), self.GetMinSize())
+
+    @staticmethod
+    def fitFactor(w, h, panelsize, minsize):
+        """Returns the factor from image size w x h to its size displayed in a panel"""
+        minfactor = min(1.0*minsize[0]/w,1.0*minsize[1]/h)
+        return max(minfactor, min(1.0*panelsize[0]/w, 1.0*panelsize[1]/h, 1.0))
+
+    def decodeImage(self, path):
+        """Decodes the image file at path and sets self.w, self.h to its full size"""
+        image, self.w, self.h = self.readImage(path, self.GetClientSize(), self.GetMinSize())
+        return image
+
+    @classmethod
+    def readImage(cls, path, panelsize, minsize):
+        """Decodes the image file at path, returns (image, full width, full height)
+
+        JPEGs are decoded using DCT scaling (1/2, 1/4, 1/8) at the smallest
+        scale still covering the size displayed in a panel of panelsize, if
+        PIL is available. Touches no window, so it may run in a worker thread."""
+        if PILImage is not None:
+            try:
+                im = PILImage.open(path)
+                if im.format == 'JPEG':
+                    w, h = im.size
+                    factor = cls.fitFactor(w, h, panelsize, minsize)
+                    im.draft('RGB', (max(1, int(w*factor)), max(1, int(h*factor))))
+                    im = im.convert('RGB')
+                    image = wx.EmptyImage(*im.size)
+                    image.SetData(im.tobytes() if hasattr(im, 'tobytes') else im.tostring())
+                    return image, w, h
+            except IOError:
+                pass
+        image = wx.Image(path, wx.BITMAP_TYPE_ANY)
+        return image, image.GetWidth(), image.GetHeight()
 
-    def setImage(self, image, rects=None):
+    def scaledBitmap(self, width, height, fast=False):
+        """Returns the image scaled to width x height as bitmap, rescales
+        only if image, size or quality changed since the last call
+
+        @param fast: scale with nearest neighbour instead of high quality"""
+        quality = wx.IMAGE_QUALITY_NORMAL if fast else wx.IMAGE_QUALITY_HIGH
+        key = (id(self.image), width, height, quality)
+        if self.bitmapKey != key:
+            self.bitmap = self.image.Scale(width, height, quality=quality).ConvertToBitmap()
+            self.bitmapKey = key
+        return self.bitmap
+
+    def averageFrameTime(self, mode):
+        """Returns the average paint time in seconds of mode 'fast' or 'high'"""
+        frames, total = self.frameTimes[mode]
+        return total / frames if frames > 0 else 0.0
+
+    def setImage(self, image, regions=None):
+        self.generation += 1
+        self.decoding = False
+        self.decodeFailed = None
+        self.decodedCallback = None
         if isinstance(image, wx.Image):
             self.image = image
+            self.imagePath = None
+            self.w = self.image.GetWidth()
+            self.h = self.image.GetHeight()
         elif os.path.isfile(image):
-            self.image = wx.Image(image, wx.BITMAP_TYPE_ANY)
+            self.imagePath = image
+            self.image = self.decodeImage(image)
         else:
             raise(IOError, 'ImagePanel.setImage(image): image neither is a wx.Image nor a path to an image file')
-        self.w = self.image.GetWidth()
-        self.h = self.image.GetHeight()
-        self.rects = rects
+        self.bitmap = None
+        self.bitmapKey = None
+        self.regions = regions
+        self.Refresh()
+
+    def showPlaceholder(self):
+        """Shows an empty transparent image of the panel size"""
+        placeholder = wx.EmptyImage(*self.GetSize())
+        placeholder.ConvertColourToAlpha(0,0,0)
+        self.setImage(placeholder)
+
+    def setDecodedImage(self, path, image, size, regions=None, callback=None):
+        """Shows image decoded from the file at path by readImage, e.g. in a worker thread
+
+        @param size: (width, height) of the full image
+        @param callback: function(path, image, (width, height)) called when the
+                         image is decoded again at a higher resolution"""
+        self.setImage(image, regions)
+        self.imagePath = path
+        self.w, self.h = size
+        self.decodedCallback = callback
+
+    def setPreview(self, data, size, regions=None):
+        """Shows the JPEG data of an embedded preview scaled to the full image size
+
+        @param size: (width, height) of the full image"""
+        image = wx.ImageFromStream(cStringIO.StringIO(data), wx.BITMAP_TYPE_JPEG)
+        if not image.IsOk():
+            raise IOError('ImagePanel.setPreview(data): cannot decode preview')
+        self.setImage(image, regions)
+        self.w, self.h = size
+
+    def setRegions(self, regions):
+        """Draws regions on the image shown"""
+        self.regions = regions
         self.Refresh()
-        
+
+    def loadImageAsync(self, path, callback=None):
+        """Decodes the image file at path in a worker thread and replaces
+        the current (preview) image with it, unless another image was set meanwhile
+
+        @param callback: function(path, image, (width, height)) called when the image is shown,
+                         and when it is decoded again at a higher resolution"""
+        self.generation += 1
+        self.decoding = True
+        self.decodedCallback = callback
+        worker = threading.Thread(target=self.decodeWorker,
+                                  args=(self.generation, path, self.GetClientSize(), self.GetMinSize(), callback))
+        worker.daemon = True
+        worker.start()
+
+    def decodeWorker(self, generation, path, panelsize, minsize, callback):
+        try:
+            image, w, h = self.readImage(path, panelsize, minsize)
+        except Exception:
+            image = None
+        if image is not None and image.IsOk():
+            wx.CallAfter(self.OnImageDecoded, generation, path, image, w, h, callback)
+        else:
+            wx.CallAfter(self.OnImageDecoded, generation, path, None, 0, 0, None)
+
+    def OnImageDecoded(self, generation, path, image, w, h, callback):
+        if not self or generation != self.generation:
+            # panel destroyed or another image set meanwhile
+            return
+        self.decoding = False
+        if image is None:
+            # could not decode, keep the current image and do not retry on paint
+            self.decodeFailed = path
+            return
+        self.image = image
+        self.imagePath = path
+        self.w, self.h = w, h
+        self.bitmap = None
+        self.bitmapKey = None
+        self.Refresh()
+        if callback is not None:
+            callback(path, image, (w, h))
+
 
 class PrivateMDPanel(wx.Panel):
     def __init__(self, parent, *args, **kwargs):
@@ -88,6 +285,7 @@ class MDTreePanel(wx.Panel):
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(self.tree, 1, wx.EXPAND)
         self.SetSizer(sizer)
+        self.tree.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnItemExpanding)
         #self.Bind(wx.EVT_CHAR, self.OnChar)
         #self.Bind(wx.EVT_TREE_KEY_DOWN, self.OnChar)
 
@@ -98,20 +296,84 @@ class MDTreePanel(wx.Panel):
         f.SetWeight(wx.FONTWEIGHT_LIGHT)
         tree.SetItemFont(root, f)
 
-    def setMetadata(self, metadatatree, reset=True):
-        def _recur(datanode, treectrlnode):
-            if len(datanode.children) > 0:
-                for currentdatanode in datanode.children:
-                    data = u': '+unifix(currentdatanode.data) if (currentdatanode.data is not None) and (unifix(currentdatanode.data) != u'') else u''
-                    child = self.tree.AppendItem(treectrlnode, currentdatanode.name+data)
-                    self.tree.SetItemFont(child, f)
-                    _recur(currentdatanode, child)
+    def updateMetadata(self, metadatatree):
+        """Shows metadatatree changing only the items that differ from the metadata
+        shown before, unchanged items keep their expansion state
 
-        f = self.GetClassDefaultAttributes().font
-        if reset == True:
-            self.tree.DeleteChildren(self.tree.GetRootItem())
-        if metadatatree.root is not None:
-            _recur(metadatatree.root, self.tree.GetRootItem())
+        Item children are matched to node children by name in order, items of
+        nodes not found are removed, items of new nodes are inserted."""
+        self.tree.Freeze()
+        try:
+            stack = [(self.tree.GetRootItem(), metadatatree.root)]
+            while stack:
+                treectrlnode, datanode = stack.pop()
+                newnodes = datanode.children if datanode is not None else []
+                items = []
+                item, cookie = self.tree.GetFirstChild(treectrlnode)
+                while item.IsOk():
+                    items.append(item)
+                    item, cookie = self.tree.GetNextChild(treectrlnode, cookie)
+                names = [self.tree.GetPyData(item).name for item in items]
+                remaining = {}
+                for name in names:
+                    remaining[name] = remaining.get(name, 0) + 1
+                i = 0 #: next item not matched yet
+                previous = None
+                for newnode in newnodes:
+                    if remaining.get(newnode.name, 0) > 0:
+                        # remove the items before the next one of this name
+                        while names[i] != newnode.name:
+                            remaining[names[i]] -= 1
+                            self.tree.Delete(items[i])
+                            i += 1
+                        item = items[i]
+                        remaining[newnode.name] -= 1
+                        i += 1
+                        label = self.itemLabel(newnode)
+                        if self.tree.GetItemText(item) != label:
+                            self.tree.SetItemText(item, label)
+                        self.tree.SetPyData(item, newnode)
+                        if self.tree.GetChildrenCount(item, False) > 0:
+                            # children added already, update them as well
+                            stack.append((item, newnode))
+                        self.tree.SetItemHasChildren(item, len(newnode.children) > 0)
+                    else:
+                        if previous is None:
+                            item = self.tree.PrependItem(treectrlnode, self.itemLabel(newnode))
+                        else:
+                            item = self.tree.InsertItem(treectrlnode, previous, self.itemLabel(newnode))
+                        self.setupItem(item, newnode)
+                    previous = item
+                for item in items[i:]:
+                    self.tree.Delete(item)
+        finally:
+            self.tree.Thaw()
+
+    def itemLabel(self, datanode):
+        data = unifix(datanode.data) if datanode.data is not None else u''
+        return datanode.name+u': '+data if data != u'' else datanode.name
+
+    def appendChildren(self, treectrlnode, datanode):
+        """Adds items for the children of datanode, their own children are added on expansion"""
+        for currentdatanode in datanode.children:
+            child = self.tree.AppendItem(treectrlnode, self.itemLabel(currentdatanode))
+            self.setupItem(child, currentdatanode)
+
+    def setupItem(self, item, datanode):
+        self.tree.SetItemFont(item, self.GetClassDefaultAttributes().font)
+        self.tree.SetPyData(item, datanode)
+        if len(datanode.children) > 0:
+            self.tree.SetItemHasChildren(item, True)
+
+    def OnItemExpanding(self, e):
+        item = e.GetItem()
+        datanode = self.tree.GetPyData(item)
+        if datanode is not None and self.tree.GetChildrenCount(item, False) == 0:
+            self.tree.Freeze()
+            try:
+                self.appendChildren(item, datanode)
+            finally:
+                self.tree.Thaw()
 
     #def OnChar(self, event):
     #    keycode = event.GetKeyCode()
@@ -178,6 +440,8 @@ class PicasaContactsDialog(wx.Dialog):
 
 
 class MainWindow(wx.Frame):
+    LOAD_DELAY = 40 #: ms without navigation before an uncached image is loaded
+
     def __init__(self, parent, id, title,  *args, **kwargs):
         wx.Frame.__init__(self, parent, id, title, *args, **kwargs)
         self.frameTitlePrefix = title
@@ -187,6 +451,9 @@ class MainWindow(wx.Frame):
         self.initImageHandling()
         # Load config from file
         self.loadConfigFromFile()
+        self.openMetadataCache()
+        self.startPrefetcher()
+        self.loadTimer = wx.PyTimer(self.OnLoadTimer)
 
         # Setting up the menu
         filemenu = wx.Menu()
@@ -202,6 +469,7 @@ class MainWindow(wx.Frame):
         menuOpenR.Check(self.browseRecursively)
         menuDlTmp = settmenu.AppendCheckItem(wx.ID_ANY, "Download URL images to ~/.mdviewer (instead of TMP)")
         menuDlTmp.Check(self.downloadURLstoHOME)
+        menucachestats = settmenu.Append(wx.ID_ANY,"Show cache &statistics","Show hits and misses of the image and metadata caches")
         menupicontacts = settmenu.Append(wx.ID_ANY,"Set Picasa &contacts.xml path","Set filepath to Picasa's contacts.xml (if not default or could not be found)")
         menuesavecfg = settmenu.Append(wx.ID_ANY,"Save &configuration now","Save configuration to file")
 
@@ -220,8 +488,10 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OpenURLTmpHome, menuDlTmp)
         self.Bind(wx.EVT_MENU, self.saveConfigToFile, menuesavecfg)
         self.Bind(wx.EVT_MENU, self.setPicasaContacts, menupicontacts)
+        self.Bind(wx.EVT_MENU, self.OnCacheStatistics, menucachestats)
         self.Bind(wx.EVT_MENU, self.OnExit, menuExit)
         self.Bind(wx.EVT_MENU, self.OnAbout, menuAbout)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
         if self.simpleView == True:
           # Define sizer
@@ -249,6 +519,8 @@ class MainWindow(wx.Frame):
           # Setup map
           self.mappanel.create_map()
 
+        self.CreateStatusBar()
+
         # Events for GUI elements
         self.imagepanel.Bind(wx.EVT_KEY_UP, self.OnKeyUp)
 
@@ -263,11 +535,28 @@ class MainWindow(wx.Frame):
         self.image_metadata = {}
         self.picasa_faces = None
         self.picasaContactsFile = None
-        self.lastImageLoadedDir = ''
+        self.picasaCache = picasa_faces.picasa_faces.PicasaCache()
         self.browseRecursively = False
         self.downloaddir = None
         self.tempdir = None
         self.downloadURLstoHOME = False
+        self.metadataCacheSize = 256 #: MB, 0 disables the metadata cache
+        self.metadataCache = None
+        self.imageCacheSize = 128 #: MB of decoded images and parsed metadata kept in memory
+        self.imageCache = None
+        self.prefetcher = None
+        self.prefetchPanelSize = None #: (client size, min size) of the image panel to decode for
+        self.browseDirection = 1 #: 1 browsing forward, -1 backward
+        self.loadGeneration = 0 #: increased with every loadImage, outdated loads are dropped
+        self.loadFailed = False #: the status bar shows a load error
+        self.scanner = None
+        self.scanGeneration = 0 #: increased with every directory scan, outdated results are dropped
+        self.download = None
+        self.downloadGeneration = 0 #: increased with every download, outdated callbacks are dropped
+        self.downloadReturn = None #: (dirname, filename) to show again if a download fails
+        self.downloadCacheSize = 512 #: MB of downloaded URLs kept in the download directory
+        self.downloadCache = None
+        self.http = download.urllib3.PoolManager() #: connections for range requests of URLs
         
     def OnAbout(self,e):
         dlg = wx.MessageDialog(self, " Photo Private Metadata Viewer \n by Benjamin Henne \n<henne@dcsec.uni-hannover.de>\n", "About photo private_metadata viewer", wx.OK)
@@ -277,6 +566,26 @@ class MainWindow(wx.Frame):
     def OnExit(self,e):
         self.Close(True)
 
+    def OnClose(self, e):
+        self.loadTimer.Stop()
+        self.loadGeneration += 1
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+        if self.download is not None:
+            self.download.cancel()
+            self.download = None
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        if self.metadataCache is not None:
+            self.metadataCache.close()
+            self.metadataCache = None
+        if self.downloadCache is not None:
+            self.downloadCache.close()
+            self.downloadCache = None
+        e.Skip()
+
     def OnOpenFile(self,e):
         dlg = wx.FileDialog(self, "Choose an image file", self.dirname, "", "*.*", wx.OPEN)
         if dlg.ShowModal() == wx.ID_OK:
@@ -299,6 +608,19 @@ class MainWindow(wx.Frame):
             self.ImplOpenDirFile(os.path.dirname(value), os.path.basename(value), type='URL')
         dlg.Destroy()
 
+    def OnCacheStatistics(self, e):
+        text = 'Image cache: %s' % self.imageCache.statistics()
+        if self.metadataCache is not None:
+            text += '\nMetadata cache: %i entries' % len(self.metadataCache)
+        if self.downloadCache is not None:
+            text += '\nDownload cache: %i URLs, %.1f of %.1f MB' % (len(self.downloadCache),
+                    self.downloadCache.totalsize / 1048576.0, self.downloadCache.maxsize / 1048576.0)
+        text += '\nAverage paint time: %.1f ms while resizing, %.1f ms in high quality' % \
+                (self.imagepanel.averageFrameTime('fast') * 1000, self.imagepanel.averageFrameTime('high') * 1000)
+        dlg = wx.MessageDialog(self, text, "Cache statistics", wx.OK | wx.ICON_INFORMATION)
+        dlg.ShowModal()
+        dlg.Destroy()
+
     def setPicasaContacts(self, e):
         dlg = PicasaContactsDialog(self, "Choose your Picasa contacts.xml storing face names")
         if self.picasaContactsFile is not None:
@@ -310,15 +632,24 @@ class MainWindow(wx.Frame):
             else:
                 self.picasaContactsFile = None
         dlg.Destroy()
-        self.loadImage(picasaReload=True)
+        self.loadImage()
 
     def OnOpenRec(self, e):
         self.browseRecursively = not self.browseRecursively
-        self.ImplOpenDirFile(self.dirname, self.filename)
+        if not private_metadata.isURL(self.dirname):
+            self.ImplOpenDirFile(self.dirname, self.filename)
 
     def OpenURLTmpHome(self, e):
         self.downloadURLstoHOME = not self.downloadURLstoHOME
         self.downloaddir = None
+        if self.download is not None:
+            # the download streams into the cache closed below
+            self.download.cancel()
+            self.download = None
+            self.downloadGeneration += 1
+        if self.downloadCache is not None:
+            self.downloadCache.close()
+            self.downloadCache = None
 
     def GUISimpleView(self, e):
         self.simpleView = not self.simpleView
@@ -348,12 +679,18 @@ class MainWindow(wx.Frame):
                                                 'dltohome': str(self.downloadURLstoHOME),
                                                 'picasaini': str(self.picasaContactsFile),
                                                 'simpleview': str(self.simpleView),
+                                                'metadatacachesize': str(self.metadataCacheSize),
+                                                'imagecachesize': str(self.imageCacheSize),
+                                                'downloadcachesize': str(self.downloadCacheSize),
                                                 })
             c.read(cfgfile)                                    
             self.browseRecursively = c.getboolean('mdviewer', 'browserecursively')
             self.downloadURLstoHOME = c.getboolean('mdviewer', 'dltohome')
             self.picasaContactsFile = c.get('mdviewer', 'picasaini')
             self.simpleView = c.getboolean('mdviewer', 'simpleview')
+            self.metadataCacheSize = c.getint('mdviewer', 'metadatacachesize')
+            self.imageCacheSize = c.getint('mdviewer', 'imagecachesize')
+            self.downloadCacheSize = c.getint('mdviewer', 'downloadcachesize')
 
     def saveConfigToFile(self, e):
         home = os.getenv('HOME') or os.getenv('USERPROFILE')
@@ -367,27 +704,228 @@ class MainWindow(wx.Frame):
         c.set('mdviewer', 'dltohome', str(self.downloadURLstoHOME))
         c.set('mdviewer', 'picasaini', str(self.picasaContactsFile))
         c.set('mdviewer', 'simpleview', str(self.simpleView))
+        c.set('mdviewer', 'metadatacachesize', str(self.metadataCacheSize))
+        c.set('mdviewer', 'imagecachesize', str(self.imageCacheSize))
+        c.set('mdviewer', 'downloadcachesize', str(self.downloadCacheSize))
         cfile = open(dir+'mdviewer.cfg', 'wb')
         c.write(cfile)
         cfile.close()
 
-    def getJpgs(self, dir, recursive):
-        list = []
-        if os.path.isdir(dir):
-            if recursive == False:
-                for file in os.listdir(dir):
-                    if file.lower().endswith('.jpg'):
-                        list.append(os.path.join(dir, file))
-            else:
-                for path, paths, files in os.walk(dir):
-                    for file in files:
-                        if file.lower().endswith('.jpg'):
-                            list.append(os.path.join(path, file))
-        return sorted(list)
-
-    def loadImage(self, picasaReload=False):
-        #TODO: try+except IOError
-    
+    def openMetadataCache(self):
+        if self.metadataCacheSize > 0:
+            try:
+                self.metadataCache = metadata_cache.MetadataCache(maxsize=self.metadataCacheSize*1024*1024)
+            except Exception as strerror:
+                sys.stderr.write('Could not open metadata cache: %s\n' % strerror)
+                self.metadataCache = None
+
+    def openDownloadCache(self):
+        """Opens the cache of downloaded URLs in the download directory, whose bodies are named by content hash"""
+        try:
+            self.downloadCache = download_cache.DownloadCache(os.path.join(self.downloaddir, 'downloads'),
+                                                              maxsize=self.downloadCacheSize*1024*1024)
+        except Exception as strerror:
+            sys.stderr.write('Could not open download cache: %s\n' % strerror)
+            self.downloadCache = None
+
+    def startPrefetcher(self):
+        self.imageCache = prefetch.SizedCache(self.imageCacheSize*1024*1024)
+        self.prefetcher = prefetch.Prefetcher(self.prefetchImage, self.imageCache,
+                                              key=metadata_cache.MetadataCache.identity)
+
+    def imageCacheEntry(self, image, size, md, mdtree):
+        """Returns the image cache entry of a decoded image and its metadata and its estimated size in bytes"""
+        # decoded RGB data dominates, metadata is estimated roughly
+        return (image, size, md, mdtree), image.GetWidth() * image.GetHeight() * 3 + 64*1024
+
+    def cacheImage(self, path, image, size, md, mdtree):
+        try:
+            key = metadata_cache.MetadataCache.identity(path)
+        except OSError:
+            return
+        self.imageCache.put(key, *self.imageCacheEntry(image, size, md, mdtree))
+
+    def prefetchImage(self, path):
+        """Loads the decoded image and metadata of path, called by the prefetcher's worker threads"""
+        panelsize, minsize = self.prefetchPanelSize
+        image, w, h = ImagePanel.readImage(path, panelsize, minsize)
+        if not image.IsOk():
+            raise IOError('Could not decode image: %s' % path)
+        md, mdtree = self.readMetadata(path)
+        return self.imageCacheEntry(image, (w, h), md, mdtree)
+
+    def readMetadata(self, filename):
+        """Returns private metadata and metadata tree of filename, from metadata cache if possible"""
+        identity = None
+        if self.metadataCache is not None:
+            try:
+                identity = self.metadataCache.identity(filename)
+            except OSError as strerror:
+                raise IOError('Could not read metadata from file: %s' % strerror)
+            cached = self.metadataCache.get(identity)
+            if cached is not None:
+                return cached
+        md = private_metadata.PrivateMetadata(filename)
+        try:
+            md.read()
+        except IOError as strerror:
+            raise IOError('Could not read metadata from file: %s' % strerror)
+        mdtree = private_metadata.MetadataTree(md, nsprefix=False)
+        if identity is not None:
+            self.metadataCache.put(identity, md, mdtree)
+        return md, mdtree
+
+    def scanJpgs(self, dir, recursive):
+        """Enumerates the JPEGs in dir in a background thread, self.filelist is updated while they are found"""
+        if self.scanner is not None:
+            self.scanner.cancel()
+        self.scanGeneration += 1
+        generation = self.scanGeneration
+        self.scanner = JpgScanner(dir, recursive, lambda paths, finished:
+                                  wx.CallAfter(self.OnJpgsFound, generation, paths, finished))
+        self.scanner.start()
+
+    def OnJpgsFound(self, generation, paths, finished):
+        """Takes the sorted list of JPEGs found so far as file list, the file
+        shown is located by binary search"""
+        if not self or generation != self.scanGeneration:
+            # window closed or another directory opened meanwhile
+            return
+        if finished:
+            self.scanner = None
+        if self.filename == '':
+            # no file opened, show the first one found
+            self.filelist = paths
+            if len(paths) > 0:
+                self.currentfileid = 0
+                self.filename = os.path.basename(self.filelist[self.currentfileid])
+                self.dirname = os.path.dirname(self.filelist[self.currentfileid])
+                self.fullname = os.path.join(self.dirname, self.filename)
+                self.loadImage()
+            return
+        position = bisect.bisect_left(paths, self.fullname)
+        if position == len(paths) or paths[position] != self.fullname:
+            # keep the file shown browsable, it is not found (yet)
+            paths.insert(position, self.fullname)
+        self.filelist = paths
+        self.currentfileid = position
+
+    def loadImage(self):
+        """Shows self.fullname, loaded by a worker thread after LOAD_DELAY ms
+        without further navigation, from the image cache if possible. No file
+        is touched here, so navigating never blocks on slow storage.
+        Loads of images navigated away from are discarded."""
+        self.loadGeneration += 1
+        self.loadTimer.Stop()
+        self.image_metadata = {}
+        if self.filename == '':
+            self.imagepanel.showPlaceholder()
+            self.showMetadata(None, private_metadata.MetadataTree(None))
+            return
+        if len(self.filelist) > 1:
+            self.prefetchPanelSize = (self.imagepanel.GetClientSize(), self.imagepanel.GetMinSize())
+            self.prefetcher.schedule(self.filelist, self.currentfileid, self.browseDirection)
+        # key repeats restart the timer, only the final image is loaded
+        self.loadTimer.Start(self.LOAD_DELAY, wx.TIMER_ONE_SHOT)
+
+    def OnLoadTimer(self):
+        worker = threading.Thread(target=self.loadWorker, args=(self.loadGeneration, self.fullname,
+                                  self.imagepanel.GetClientSize(), self.imagepanel.GetMinSize(),
+                                  self.picasaContactsFile))
+        worker.daemon = True
+        worker.start()
+
+    def loadWorker(self, generation, path, panelsize, minsize, contactsXML):
+        """Loads metadata and the embedded preview of path, or the decoded image
+        if there is no preview, runs in a worker thread started by loadImage"""
+        try:
+            # picasa metadata from .picasa.ini, parsed again only if it or the contacts changed
+            faces = self.picasaCache.getFaces(os.path.dirname(path), contactsXML)
+            # image cache lookup, waits if the prefetcher loads path right now
+            prefetcher = self.prefetcher
+            entry = prefetcher.get(path) if prefetcher is not None else None
+            preview = None
+            if entry is None:
+                if generation != self.loadGeneration:
+                    return
+                # the Exif thumbnail first, reading the full metadata takes longer
+                try:
+                    header = jpeg_metadata.JpegHeaderMetadata.from_file(path)
+                except (IOError, jpeg_metadata.JpegHeaderError):
+                    header = None
+                thumbnail = embeddedPreview(header)
+                if thumbnail is not None:
+                    wx.CallAfter(self.OnPreviewLoaded, generation, thumbnail)
+                md, mdtree = self.readMetadata(path)
+                preview = embeddedPreview(header, md)
+                if preview is None:
+                    if generation != self.loadGeneration:
+                        return
+                    image, w, h = ImagePanel.readImage(path, panelsize, minsize)
+                    if not image.IsOk():
+                        raise IOError('Could not decode image: %s' % path)
+                    entry = (image, (w, h), md, mdtree)
+                    self.cacheImage(path, image, (w, h), md, mdtree)
+                else:
+                    entry = (None, None, md, mdtree)
+                    if thumbnail is not None and preview[0] is thumbnail[0]:
+                        # shown already
+                        preview = None
+        except Exception as strerror:
+            sys.stderr.write('%s\n' % strerror)
+            wx.CallAfter(self.OnImageLoadFailed, generation, path, strerror)
+            return
+        wx.CallAfter(self.OnImageLoaded, generation, path, entry, preview, faces)
+
+    def OnPreviewLoaded(self, generation, preview):
+        """Shows the Exif thumbnail of the image loaded while its metadata is read"""
+        if not self or generation != self.loadGeneration:
+            return
+        try:
+            self.imagepanel.setPreview(preview[0], preview[1])
+        except IOError:
+            self.imagepanel.showPlaceholder()
+
+    def OnImageLoaded(self, generation, path, entry, preview, faces):
+        """Shows a loaded image cache entry, or its preview while the full image is decoded
+
+        @param preview: embedded preview to show, None if shown already by OnPreviewLoaded"""
+        if not self or generation != self.loadGeneration:
+            # window closed or navigated to another image meanwhile
+            return
+        if self.loadFailed:
+            self.SetStatusText('')
+            self.loadFailed = False
+        image, size, md, mdtree = entry
+        self.picasa_faces = faces
+        self.showMetadata(md, mdtree)
+        cache = lambda path, image, size: self.cacheImage(path, image, size, md, mdtree)
+        if image is not None:
+            self.imagepanel.setDecodedImage(path, image, size, regions=self.image_regions, callback=cache)
+            return
+        # paint the embedded preview now, the full image when decoded
+        if preview is not None:
+            try:
+                self.imagepanel.setPreview(preview[0], preview[1], regions=self.image_regions)
+            except IOError:
+                pass
+        else:
+            self.imagepanel.setRegions(self.image_regions)
+        self.imagepanel.loadImageAsync(path, callback=cache)
+
+    def OnImageLoadFailed(self, generation, path, error):
+        """Shows the name of the image that could not be loaded without image and metadata"""
+        if not self or generation != self.loadGeneration:
+            return
+        self.imagepanel.showPlaceholder()
+        self.picasa_faces = None
+        self.showMetadata(None, private_metadata.MetadataTree(None))
+        self.SetStatusText('Could not load %s: %s' % (path, error))
+        self.loadFailed = True
+
+    def showMetadata(self, md, mdtree):
+        """Updates title, private metadata, tree and map to the image shown"""
+
         def shortenedfilename(flen=30, dlen=50):
             base = self.filename
             dir = self.dirname
@@ -396,32 +934,16 @@ class MainWindow(wx.Frame):
             if len(dir) > dlen - len(base):
                 dir = dir[0:(dlen - len(base))/2-2]+'[..]'+dir[-(dlen - len(base))/2-2:]
             return '%s/%s' % (dir, base)
-        
+
+        self.md, self.mdtree = md, mdtree
         self.image_metadata = {}
-        if self.filename != '':
-            # picasa metadata from .picasa.ini
-            if self.dirname != self.lastImageLoadedDir or picasaReload == True:
-                    if os.path.isfile(os.path.join(self.dirname, '.picasa.ini')):
-                        self.picasa_faces = picasa_faces.picasa_faces.PicasaIniFaces(self.dirname, picasa_faces.picasa_faces.PicasaContacts(self.picasaContactsFile))
-            # image metadata from image file
-            self.md = private_metadata.PrivateMetadata(self.fullname)
-            try:
-                self.md.read()
-            except IOError as strerror:
-                raise IOError('Could not read metadata from file: %s' % strerror)
-            self.parseMetadata(self.md, self.picasa_faces)
-            self.imagepanel.setImage(self.fullname, rects=self.image_rects)
-        else:
-            placeholder = (wx.EmptyImage(*self.GetSize()))
-            placeholder.ConvertColourToAlpha(0,0,0)
-            self.imagepanel.setImage(placeholder)
+        if md is not None:
+            self.parseMetadata(md, self.picasa_faces)
         self.privmdpanel.text.SetValue(str(self.image_metadata))
         frameTitleSuffix = ': %s' % shortenedfilename() if self.filename != '' else ''
         self.SetTitle(self.frameTitlePrefix+frameTitleSuffix)
-        self.lastImageLoadedDir = self.dirname
         if self.simpleView == False:
-            self.mdtree = private_metadata.MetadataTree(self.md, nsprefix=False)
-            self.mdtreepanel.setMetadata(self.mdtree)
+            self.mdtreepanel.updateMetadata(self.mdtree)
             self.privmdpanel.text.SetValue(str(self.image_metadata))
             if 'WGS84' in self.image_metadata:
                 loc = self.image_metadata['WGS84']
@@ -442,31 +964,16 @@ class MainWindow(wx.Frame):
 
 
     def parseMetadata(self, md, picasa_faces):
-        rects = []
+        regions = []
         people = []
         if picasa_faces is not None and self.filename in picasa_faces.faces and \
-           picasa_faces.faces[self.filename] is not None and len(picasa_faces.faces[self.filename]) > 0:
-                for i in picasa_faces.faces[self.filename]:
-                    people.append(i[0])
-                    rects.append([ i[0], i[1][0], i[1][1], i[1][2], i[1][3], 'blue' ])
-        mpri = md.privateMetadata['people:mpri'].value
-        if mpri is not None and len(mpri) > 0:
-            for i in mpri:
-                people.append(i[1])
-                if i[0] & private_metadata.MdMPRI.RECTANGLE:
-                    rects.append([ i[1], i[2], i[3], i[4], i[5], 'red' ])
-        mwgrs = md.privateMetadata['people:mwgrs'].value
-        if mwgrs is not None and len(mwgrs) > 0:
-            for i in mwgrs:
-                people.append(i[1])
-                if i[0] & private_metadata.MdMwgRs.RECTANGLE:
-                    rects.append([ i[1], i[2]-i[4]/2, i[3]-i[5]/2, i[4], i[5], 'green' ])
-                if i[0] & private_metadata.MdMwgRs.CIRCLE:
-                    # use diameter as width and height
-                    rects.append([ i[1], i[2]-i[4]/2, i[3]-i[4]/2, i[4], i[4], 'green' ])
-                if i[0] & private_metadata.MdMwgRs.POINT:
-                    d = 0.04
-                    rects.append([ i[1], i[2]-d/2, i[3]-d/2, d, d, 'green' ])
+           picasa_faces.faces[self.filename] is not None:
+                regions += picasa_faces.faces[self.filename]
+        for name in ('people:mpri', 'people:mwgrs'):
+            value = md.privateMetadata[name].value
+            if value is not None:
+                regions += value
+        people += [r.name for r in regions]
         mediaproppl = md.privateMetadata['people:mediapro'].value
         if mediaproppl is not None:
             people.append(mediaproppl)
@@ -474,16 +981,21 @@ class MainWindow(wx.Frame):
         if iptc4extPII is not None:
             people.append(iptc4extPII)
 
-        if len(rects) > 0:
-            self.image_rects = rects
+        if len(regions) > 0:
+            self.image_regions = regions
         else:
-            self.image_rects = None
+            self.image_regions = None
         self.image_metadata['people'] = sorted(people)
 	if md.privateMetadata['location:wgs84'].value is not None:
 		self.image_metadata['WGS84'] = md.privateMetadata['location:wgs84'].value
 
     def ImplOpenDirFile(self, directory, filename, type='file'):
             if type == 'file':
+                if self.download is not None:
+                    # another file opened meanwhile
+                    self.download.cancel()
+                    self.download = None
+                    self.downloadGeneration += 1
                 self.ImplNextImage = self.ImplNextImageLocal
                 self.ImplPreviousImage = self.ImplPreviousImageLocal
             elif type == 'URL':
@@ -504,31 +1016,140 @@ class MainWindow(wx.Frame):
                             import tempfile
                             self.tempdir = tempfile.mkdtemp()
                         self.downloaddir = self.tempdir
-                import urllib2
-                try:
-                    dlfile = open('%s/%s' % (self.downloaddir, filename), 'wb')
-                    dlfile.write(urllib2.urlopen('%s/%s' % (directory, filename)).read())
-                    dlfile.close()
-                    directory = self.downloaddir
-                except IOError:
-                    sys.stderr.write('URL not found: %s/%s' % (directory, filename))
-                    directory = self.dirname
-                    filename = self.filename
+                if self.downloadCache is None:
+                    self.openDownloadCache()
+                if not private_metadata.isURL(self.dirname):
+                    # not the metadata of another URL shown while downloading
+                    self.downloadReturn = (self.dirname, self.filename)
+                self.openURL('%s/%s' % (directory, filename), os.path.join(self.downloaddir, filename))
+                return
             self.dirname = directory
             self.filename = filename
             self.fullname = os.path.join(self.dirname, self.filename)
-            self.filelist = self.getJpgs(self.dirname, self.browseRecursively)
-            if len(self.filelist) > 0:
-                if self.filename == '':
-                    self.currentfileid = 0
-                    self.filename = os.path.basename(self.filelist[self.currentfileid])
-                    self.dirname = os.path.dirname(self.filelist[self.currentfileid])
-                    self.fullname = os.path.join(self.dirname, self.filename)
-                else:
-                    self.currentfileid = self.filelist.index(self.fullname)
-
+            # browse the file opened at once, the directory's files when found
+            self.filelist = [self.fullname] if self.filename != '' else []
+            self.currentfileid = 0
+            self.scanJpgs(self.dirname, self.browseRecursively)
             self.loadImage()
 
+    def openURL(self, url, path):
+        """Shows the metadata of url fetched by HTTP range requests, then downloads it to path for display.
+        URLs in the download cache are revalidated and opened from the cache at once if unchanged."""
+        if self.download is not None:
+            self.download.cancel()
+            self.download = None
+        if self.downloadCache is not None and self.downloadCache.lookup(url) is not None:
+            self.startDownload(url, path)
+            return
+        self.downloadGeneration += 1
+        worker = threading.Thread(target=self.remoteMetadataWorker, args=(self.downloadGeneration, url, path))
+        worker.daemon = True
+        self.SetStatusText('Reading metadata of %s' % url)
+        worker.start()
+
+    def remoteMetadataWorker(self, generation, url, path):
+        try:
+            # unreadable headers are left to the download, not fetched twice
+            md = private_metadata.PrivateMetadata.from_url(url, self.http, complete=False)
+            header = jpeg_metadata.JpegHeaderMetadata.from_buffer(md.buffer)
+        except (IOError, jpeg_metadata.JpegHeaderError) as strerror:
+            sys.stderr.write('Could not read metadata of %s by range requests: %s\n' % (url, strerror))
+            md = None
+        wx.CallAfter(self.OnRemoteMetadata, generation, url, path, md, embeddedPreview(header) if md is not None else None)
+
+    def OnRemoteMetadata(self, generation, url, path, md, preview):
+        if not self or generation != self.downloadGeneration:
+            return
+        if md is not None and md.backend == 'header':
+            self.OnDownloadHeader(generation, url, md, preview)
+            self.startDownload(url, path, headers=False)
+        else:
+            # find the headers while downloading
+            self.startDownload(url, path)
+
+    def startDownload(self, url, path, headers=True):
+        """Downloads url to path, or into the download cache if open, in the background and opens it when complete
+
+        @param headers: show the metadata as soon as the JPEG headers arrived"""
+        if self.download is not None:
+            self.download.cancel()
+        self.downloadGeneration += 1
+        generation = self.downloadGeneration
+        self.download = download.Download(url, path,
+            progress=lambda received, total: wx.CallAfter(self.OnDownloadProgress, generation, url, received, total),
+            header=(lambda data: self.downloadHeader(generation, url, data)) if headers else None,
+            done=lambda path, error: wx.CallAfter(self.OnDownloadDone, generation, url, path, error),
+            cache=self.downloadCache)
+        self.SetStatusText('Downloading %s' % url)
+        self.download.start()
+
+    def downloadHeader(self, generation, url, data):
+        """Parses the private metadata of the JPEG headers downloaded so far, runs in the download thread"""
+        try:
+            header = jpeg_metadata.JpegHeaderMetadata.from_buffer(data)
+            md = private_metadata.PrivateMetadata.from_buffer(data)
+            md.read(backend='header')
+        except (IOError, jpeg_metadata.JpegHeaderError):
+            return
+        if md.backend != 'header':
+            return
+        wx.CallAfter(self.OnDownloadHeader, generation, url, md, embeddedPreview(header))
+
+    def OnDownloadHeader(self, generation, url, md, preview):
+        if not self or generation != self.downloadGeneration:
+            return
+        # stop showing the image before, its loads are outdated now
+        self.loadGeneration += 1
+        self.loadTimer.Stop()
+        # the file is named when complete, show the URL meanwhile
+        self.dirname, self.filename = url.rsplit('/', 1)
+        self.fullname = url
+        self.picasa_faces = None
+        self.showMetadata(md, private_metadata.MetadataTree(None))
+        try:
+            if preview is None:
+                raise IOError('no preview')
+            self.imagepanel.setPreview(preview[0], preview[1], regions=self.image_regions)
+        except IOError:
+            self.imagepanel.showPlaceholder()
+
+    def OnDownloadProgress(self, generation, url, received, total):
+        if not self or generation != self.downloadGeneration:
+            return
+        if total is not None and total > 0:
+            self.SetStatusText('Downloading %s: %i of %i KB (%i%%)' % (url, received/1024, total/1024, 100*received/total))
+        else:
+            self.SetStatusText('Downloading %s: %i KB' % (url, received/1024))
+
+    def OnDownloadDone(self, generation, url, path, error):
+        if not self or generation != self.downloadGeneration:
+            return
+        self.download = None
+        if error is not None:
+            sys.stderr.write('URL not found: %s (%s)\n' % (url, error))
+            self.SetStatusText('Could not download %s: %s' % (url, error))
+            if self.fullname == url:
+                # metadata of the failed download is shown, back to the last file
+                self.ImplOpenDirFile(*self.downloadReturn)
+            return
+        self.SetStatusText('Downloaded %s' % url)
+        self.openDownloaded(url, path)
+
+    def openDownloaded(self, url, path):
+        """Shows the downloaded file at path under the name of url, without
+        browsing the other files of the download directory"""
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+        self.scanGeneration += 1
+        self.ImplNextImage = lambda *x, **xx: None
+        self.ImplPreviousImage = lambda *x, **xx: None
+        self.dirname, self.filename = url.rsplit('/', 1)
+        self.fullname = path
+        self.filelist = [path]
+        self.currentfileid = 0
+        self.loadImage()
+
     def ImplNextImage(self):
         pass
         
@@ -536,6 +1157,7 @@ class MainWindow(wx.Frame):
         pass
 
     def ImplNextImageLocal(self):
+        self.browseDirection = 1
         try:
             self.currentfileid = (self.currentfileid + 1) % len(self.filelist)
             self.filename = os.path.basename(self.filelist[self.currentfileid])
@@ -546,6 +1168,7 @@ class MainWindow(wx.Frame):
             pass
 
     def ImplPreviousImageLocal(self):
+        self.browseDirection = -1
         try:
             self.currentfileid = (self.currentfileid - 1) % len(self.filelist)
             self.filename = os.path.basename(self.filelist[self.currentfileid])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""Persistent SQLite cache of parsed private metadata and metadata trees
+
+Entries are keyed by the file's path and validated by its size, mtime and
+inode from a single stat call, so unchanged files never reach libexiv2
+again. The cache is bounded in size, least recently used entries are
+evicted first."""
+
+import os
+import time
+import marshal
+import sqlite3
+import private_metadata
+from sqlite_cache import SQLiteCache
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+def defaultCacheFile():
+    home = os.getenv('HOME') or os.getenv('USERPROFILE')
+    return os.path.join(home, '.mdviewer', 'metadata.cache')
+
+
+class MetadataCache(SQLiteCache):
+    """Caches private metadata values and serialized MetadataTrees on disk"""
+
+    SCHEMA_VERSION = 3 #: increase on changes of tables or stored data
+    COMMIT_INTERVAL = 100 #: cache hits are committed in batches
+    TABLES = { 'entries': 'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                          'inode INTEGER, data BLOB, datasize INTEGER, used REAL' }
+    INDEXES = { 'entries_used': ('entries', 'used') }
+    TABLE = 'entries'
+    KEY = 'path'
+    SIZE = 'datasize'
+
+    def __init__(self, filename=None, maxsize=256*1024*1024):
+        """@param filename: SQLite database file, default ~/.mdviewer/metadata.cache
+           @param maxsize: maximum size of stored data in bytes"""
+        if filename is None:
+            filename = defaultCacheFile()
+        super(MetadataCache, self).__init__(filename, maxsize)
+
+    @staticmethod
+    def identity(path):
+        """Returns the cache key (path, size, mtime_ns, inode) of path using one stat call"""
+        st = os.stat(path)
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return (os.path.abspath(path), st.st_size, mtime_ns, st.st_ino)
+
+    def get(self, identity):
+        """Returns (StoredPrivateMetadata, MetadataTree) or None if not cached"""
+        path, size, mtime_ns, inode = identity
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, inode, data FROM entries WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+            if tuple(row[0:3]) != (size, mtime_ns, inode):
+                self.remove(path)
+                return None
+            try:
+                values, tree = marshal.loads(str(row[3]))
+            except (ValueError, EOFError, TypeError):
+                self.remove(path)
+                return None
+            self.db.execute('UPDATE entries SET used = ? WHERE path = ?', (time.time(), path))
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_INTERVAL:
+                self.commit()
+        return (private_metadata.StoredPrivateMetadata(path, values),
+                private_metadata.MetadataTree.deserialize(tree))
+
+    def put(self, identity, md, tree):
+        """Stores private metadata and MetadataTree of the file identified by identity
+
+        @param md: PrivateMetadata or StoredPrivateMetadata
+        @param tree: MetadataTree"""
+        path, size, mtime_ns, inode = identity
+        try:
+            data = marshal.dumps((md.privateValues(), tree.serialize()))
+        except Exception:
+            # unserializable value types or trees, do not cache
+            return
+        with self.lock:
+            self.remove(path)
+            self.db.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (path, size, mtime_ns, inode, sqlite3.Binary(data), len(data), time.time()))
+            self.totalsize += len(data)
+            if self.totalsize > self.maxsize:
+                self.evict(self.maxsize * 9 / 10)
+            self.commit()
+
+    def remove(self, path):
+        with self.lock:
+            row = self.db.execute('SELECT datasize FROM entries WHERE path = ?', (path,)).fetchone()
+            if row is not None:
+                self.db.execute('DELETE FROM entries WHERE path = ?', (path,))
+                self.totalsize -= row[0]
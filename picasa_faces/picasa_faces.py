@@ -3,8 +3,15 @@
 @author: B. Henne"""
 
 import os
+import sys
+import threading
 from xml.etree import ElementTree as ET
 
+if __name__ == '__main__':
+    # run as a script, find the top-level lib package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.region import Region
+
 __author__ = "B. Henne"
 __contact__ = "henne@dcsec.uni-hannover.de"
 __copyright__ = "(c) 2012, B. Henne"
@@ -87,7 +94,7 @@ class PicasaIniFaces(object):
             raise IOError('Folder %s does not exist.' % folder)
         f = open(self.inifile, 'rt')
         thefile = None  #: filename
-        thefaces = None #: list of face coordinates (left, top, width, height) \in 0..1
+        thefaces = None #: list of face Regions
         for line in f:
             l = line[:-1]
             if l.startswith('['):
@@ -111,8 +118,8 @@ class PicasaIniFaces(object):
                     coords = [clist[0:4], clist[4:8], clist[8:12], clist[12:16]]
                     coords = [int(coords[0],16)/65535.0, int(coords[1],16)/65535.0, 
                               int(coords[2],16)/65535.0, int(coords[3],16)/65535.0] # left, top, right, bottom
-                    coords = [coords[0], coords[1], coords[2]-coords[0], coords[3]-coords[1]] #: left, top, width, height
-                    face = [hash, coords]
+                    face = Region(Region.FACE | Region.RECTANGLE, hash, 'picasa.ini',
+                                  coords[0], coords[1], coords[2]-coords[0], coords[3]-coords[1])
                     if hash != 'ffffffffffffffff' or include_unnamed == True:
                         thefaces.append(face)
                 self.faces[thefile] = thefaces
@@ -121,15 +128,83 @@ class PicasaIniFaces(object):
         for file, faces in self.faces.items():
             s += '%s\n' % file
             for face in faces:
-                s += '+ %s (%0.5f, %0.5f, %0.5f, %0.5f)\n' % (face[0], face[1][0], face[1][1], face[1][2], face[1][3])
+                s += '+ %s (%0.5f, %0.5f, %0.5f, %0.5f)\n' % (face.name, face.left, face.top, face.width, face.height)
         return s[:-1]
-            
+
+
+class PicasaCache(object):
+    """Caches parsed .picasa.ini files and the Picasa contacts for a session
+
+    A .picasa.ini file is parsed again only if its mtime changed, the
+    contacts file only if its mtime or the requested contacts file changed.
+    Default paths of contacts.xml are probed once. Thread-safe, so
+    lookups may run in worker threads."""
+
+    def __init__(self):
+        super(PicasaCache, self).__init__()
+        self.lock = threading.RLock()
+        self.contacts = None #: PicasaContacts last loaded
+        self.contactsKey = None #: (requested contactsXML, mtime of loaded file) of self.contacts
+        self.inifaces = {} #: folder -> (mtime of .picasa.ini, PicasaContacts used, PicasaIniFaces)
+
+    def getContacts(self, contactsXML):
+        """Returns PicasaContacts of contactsXML, None searches the default paths
+
+        @param contactsXML: filename w/path of contacts XML file"""
+        with self.lock:
+            if self.contacts is not None and self.contactsKey[0] == contactsXML:
+                if self.contacts.contactsXML is None:
+                    # not found, do not probe again
+                    return self.contacts
+                try:
+                    if os.stat(self.contacts.contactsXML).st_mtime == self.contactsKey[1]:
+                        return self.contacts
+                except OSError:
+                    pass
+            contacts = PicasaContacts(contactsXML)
+            mtime = None
+            if contacts.contactsXML is not None:
+                try:
+                    mtime = os.stat(contacts.contactsXML).st_mtime
+                except OSError:
+                    pass
+            self.contacts = contacts
+            self.contactsKey = (contactsXML, mtime)
+            return contacts
+
+    def getFaces(self, folder, contactsXML=None):
+        """Returns PicasaIniFaces of folder, None if it has no .picasa.ini
+
+        @param contactsXML: filename w/path of contacts XML file, see getContacts"""
+        with self.lock:
+            contacts = self.getContacts(contactsXML)
+            try:
+                mtime = os.stat(os.path.join(folder, '.picasa.ini')).st_mtime
+            except OSError:
+                self.inifaces.pop(folder, None)
+                return None
+            entry = self.inifaces.get(folder)
+            if entry is not None and entry[0] == mtime and entry[1] is contacts:
+                return entry[2]
+            try:
+                faces = PicasaIniFaces(folder, picasaContacts=contacts)
+            except IOError:
+                self.inifaces.pop(folder, None)
+                return None
+            self.inifaces[folder] = (mtime, contacts, faces)
+            return faces
+
+
 
 def test():
+    samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+    contactsXML = os.path.join(samples, 'contacts.xml')
     c = PicasaContacts(None)
-    c = PicasaContacts('samples/contacts.xml')
-    t = PicasaIniFaces('samples', picasaContacts=c)
+    c = PicasaContacts(contactsXML)
+    t = PicasaIniFaces(samples, picasaContacts=c)
     print t
+    cache = PicasaCache()
+    assert cache.getFaces(samples, contactsXML) is cache.getFaces(samples, contactsXML)
 
 
 if __name__ == '__main__':
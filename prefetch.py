@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""Background prefetching of images and metadata while browsing
+
+A pool of worker threads loads the files ahead of the current one in
+browsing direction first, then those behind it. Loaded entries land in a
+cache bounded by their estimated size in bytes and keyed by the files'
+identity, so changed files are loaded again. Pending jobs are replaced
+on every move, so workers never lag behind the browsing position."""
+
+import threading
+import collections
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class SizedCache(object):
+    """Thread-safe cache bounded by the estimated size of its entries,
+    least recently used entries are evicted first. Counts hits and misses."""
+
+    def __init__(self, maxsize):
+        """@param maxsize: maximum total size of all entries in bytes"""
+        super(SizedCache, self).__init__()
+        self.maxsize = maxsize
+        self.totalsize = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict() #: key -> (value, size), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value of key or None if not cached"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Stores value of estimated size bytes, entries larger than the cache are not stored"""
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.totalsize -= old[1]
+            if size > self.maxsize:
+                return
+            self.entries[key] = (value, size)
+            self.totalsize += size
+            while self.totalsize > self.maxsize:
+                oldkey, (oldvalue, oldsize) = self.entries.popitem(last=False)
+                self.totalsize -= oldsize
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.totalsize = 0
+
+    def statistics(self):
+        """Returns a one line summary of size, entries, hits and misses"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return '%i entries, %.1f of %.1f MB, %i hits, %i misses (%.0f%% hit rate)' % \
+                   (len(self.entries), self.totalsize / 1048576.0, self.maxsize / 1048576.0,
+                    self.hits, self.misses, 100.0 * self.hits / requests if requests > 0 else 0.0)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+class Prefetcher(object):
+    """Loads files around the browsing position in worker threads"""
+
+    WORKERS = 2 #: number of worker threads
+    AHEAD = 4 #: files prefetched in browsing direction
+    BEHIND = 1 #: files prefetched against browsing direction
+
+    def __init__(self, load, cache, key=lambda path: path):
+        """@param load: function(path) returning (value, estimated size in bytes),
+                        called in the worker threads
+           @param cache: SizedCache the loaded values are stored in
+           @param key: function(path) returning the cache key of path, may raise OSError"""
+        super(Prefetcher, self).__init__()
+        self.load = load
+        self.cache = cache
+        self.key = key
+        self.jobs = collections.deque() #: paths to load, next first
+        self.loading = set() #: paths currently loaded by workers
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.workers = []
+        for i in xrange(self.WORKERS):
+            worker = threading.Thread(target=self.work, name='prefetch-%i' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def schedule(self, filelist, position, direction=1):
+        """Replaces the pending jobs by the files around position in filelist.
+        Touches no file, the workers skip files already cached.
+
+        @param direction: 1 if browsing forward, -1 if backward"""
+        n = len(filelist)
+        positions = [(position + direction*i) % n for i in xrange(1, self.AHEAD+1)] + \
+                    [(position - direction*i) % n for i in xrange(1, self.BEHIND+1)]
+        paths = []
+        for i in positions:
+            path = filelist[i]
+            if i == position or path in paths:
+                continue
+            paths.append(path)
+        with self.condition:
+            self.jobs.clear()
+            self.jobs.extend(path for path in paths if path not in self.loading)
+            self.condition.notify_all()
+
+    def get(self, path):
+        """Returns the prefetched value of path or None, waits if path is loaded right now"""
+        with self.condition:
+            while path in self.loading:
+                self.condition.wait()
+        try:
+            return self.cache.get(self.key(path))
+        except OSError:
+            return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                while len(self.jobs) == 0 and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                path = self.jobs.popleft()
+                self.loading.add(path)
+            try:
+                key = self.key(path)
+                if key not in self.cache:
+                    value, size = self.load(path)
+                    self.cache.put(key, value, size)
+            except Exception:
+                # left to the synchronous load, which reports errors
+                pass
+            finally:
+                with self.condition:
+                    self.loading.discard(path)
+                    self.condition.notify_all()
+
+    def stop(self, timeout=1.0):
+        """Drops pending jobs and waits up to timeout seconds per worker for its current job"""
+        with self.condition:
+            self.stopped = True
+            self.jobs.clear()
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
@@ -1,8 +1,22 @@
 #!/usr/bin/env python
 
-"""Module for privacy-related high-level photo metadata management"""
+"""Module for privacy-related high-level photo metadata management
 
+Run 'python private_metadata.py scan DIR' to extract the private metadata
+of all JPEG files below DIR without GUI."""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import collections
+import multiprocessing
 import pyexiv2
+import jpeg_metadata
+import download
+from lib.region import Region
 
 __author__ = "B. Henne"
 __contact__ = "henne@dcsec.uni-hannover.de"
@@ -15,7 +29,7 @@ class Metadatum(object):
         self.name = name
         self.key = key
         self.description = description
-        if isinstance(value, pyexiv2.ImageMetadata):
+        if isinstance(value, (pyexiv2.ImageMetadata, jpeg_metadata.JpegHeaderMetadata)):
             self.parse(value)
         else:
             self.value = value
@@ -26,12 +40,32 @@ class Metadatum(object):
         else:
             self.value = None
             self.raw_value = None
+    def dump(self):
+        """Returns the value as builtin types, e.g. for storage"""
+        return self.value
+    @classmethod
+    def load(cls, dumped):
+        """Returns a Metadatum with the value from dump()"""
+        return cls(dumped)
     def __str__(self):
         return '%s: %s' % (self.name, self.value)
     def __repr__(self):
         return self.__str__()
 
 
+class MdRegions(Metadatum):
+    """An abstract metadatum with a list of Regions as value"""
+    def dump(self):
+        if self.value is None:
+            return None
+        return [r.astuple() for r in self.value]
+    @classmethod
+    def load(cls, dumped):
+        if dumped is None:
+            return cls(None)
+        return cls([Region.fromtuple(t) for t in dumped])
+
+
 class MdMediaproPpl(Metadatum):
     """Xmp iView Media Pro schema: People"""
     def __init__(self, value):
@@ -48,129 +82,139 @@ class MdIptc4ExtPpl(Metadatum):
                                              description='Xmp IPTC Extension schema: PersonsInImage')
 
      
-class MdMwgRs(Metadatum):
+class MdMwgRs(MdRegions):
     """Xmp Metadata Working Group Region Schema
     
     @see http://www.metadataworkinggroup.org/pdf/mwg_guidance.pdf"""
-    UNKNOWN = 1024
-    POINT = 1
-    CIRCLE = 2
-    RECTANGLE = 4
-    FACE = 8
-    PET = 16
-    FOCUS = 32
-    BARCODE = 64 
+    UNKNOWN = Region.UNKNOWN
+    POINT = Region.POINT
+    CIRCLE = Region.CIRCLE
+    RECTANGLE = Region.RECTANGLE
+    FACE = Region.FACE
+    PET = Region.PET
+    FOCUS = Region.FOCUS
+    BARCODE = Region.BARCODE
+    TYPES = { 'face': FACE, 'pet': PET, 'focus': FOCUS, 'barcode': BARCODE }
     def __init__(self, value):
         super(MdMwgRs, self).__init__(name='mwg-rs', value=value, 
                                       key='Xmp.mwg-rs.Regions',
                                       description='Xmp Metadata Working Group Region Schema Data')
     @classmethod
     def example(self):
-        """List of Tuples with [type, name, x, y <, diameter|{width, height}>]"""
-        return [ [self.FACE | self.POINT,     'John Doe', 0.2, 0.2 ],
-                 [self.FACE | self.CIRCLE,    'Jane Doe', 0.4, 0.4, 0.1],
-                 [self.FACE | self.RECTANGLE, 'J.J. Doe', 0.6, 0.6, 0.1, 0.1] ]
+        """List of Regions, MWG points, circles and rectangles are stored by their center"""
+        return [ Region.fromCenter(self.FACE | self.POINT,     'John Doe', 'mwg-rs', 0.2, 0.2, 0.0, 0.0),
+                 Region.fromCenter(self.FACE | self.CIRCLE,    'Jane Doe', 'mwg-rs', 0.4, 0.4, 0.1, 0.1),
+                 Region.fromCenter(self.FACE | self.RECTANGLE, 'J.J. Doe', 'mwg-rs', 0.6, 0.6, 0.1, 0.1) ]
     def parse(self, imageMetadata):
-        if 'Xmp.mwg-rs.Regions/mwg-rs:AppliedToDimensions' in imageMetadata:
-            if 'Xmp.mwg-rs.Regions/mwg-rs:AppliedToDimensions/stDim:w' in imageMetadata and 'Xmp.mwg-rs.Regions/mwg-rs:AppliedToDimensions/stDim:h' in imageMetadata:
-               self.AppliedToDimensions = (imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:AppliedToDimensions/stDim:w'].value,
-                                           imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:AppliedToDimensions/stDim:h'].value,
-                                           imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:AppliedToDimensions/stDim:unit'].value)
-        if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList' in imageMetadata:
-            i = 1
-            self.value = []
-            while 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]' % i in imageMetadata:
-                v = None
-                # Area in RegionStruct is required
-                if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Area') in imageMetadata:
-                    # OPTIONAL
-                    # Type is optional closed choise
-                    type = self.UNKNOWN
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Type') in imageMetadata:
-                        t = imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Type')].value.lower()
-                        if t == 'face':
-                            type = self.FACE
-                        elif t == 'pet':
-                            type = self.PET
-                        elif t == 'focus':
-                            type = self.FOCUS
-                        elif t == 'barcode':
-                            type = self.BARCODE                        
-                    # Name/short Description of Region is optional
-                    name = ''
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Name') in imageMetadata:
-                        name = imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Name')].value
-                    # Description of Region is optional
-                    description = ''
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Description') in imageMetadata:
-                        description = imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:%s' % (i, 'Description')].value
-                    #TODO: FocusUsage, BarCodeValue, Extensions
-                    # parse REQUIRED Area values
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'x') in imageMetadata:
-                        xcenter =  float(imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'x')].value)
-                    else:
-                        xcenter = float('-inf')
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'y') in imageMetadata:
-                        ycenter =  float(imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'y')].value)
-                    else:
-                        ycenter = float('-inf')
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'w') in imageMetadata:
-                        width =  float(imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'w')].value)
-                    else:
-                        width = float('-inf')
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'h') in imageMetadata:
-                        height =  float(imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'h')].value)
-                    else:
-                        height = float('-inf')
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'd') in imageMetadata:
-                        diameter =  float(imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'd')].value)
-                    else:
-                        diameter = float('-inf')
-                    if 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'unit') in imageMetadata:
-                        unit =  imageMetadata['Xmp.mwg-rs.Regions/mwg-rs:RegionList[%i]/mwg-rs:Area/stArea:%s' % (i, 'unit')].value
-                    else:
-                        unit = 'normalized'
-                    # and see what we've got
-                    if (xcenter >= 0) and (ycenter >= 0):
-                        # rectangle
-                        if (width >= 0) and (height >= 0):
-                            type |= self.RECTANGLE
-                            v = [type, name, xcenter, ycenter, width, height]
-                            #v = [type, name, xcenter-width/2, ycenter-height/2, width, height]
-                        # circle
-                        elif (diameter >= 0):
-                            type |= self.CIRCLE
-                            v = [type, name, xcenter, ycenter, diameter]
-                        # point
-                        else:
-                            type |= self.POINT
-                            v = [type, name, xcenter, ycenter]
-                    else:
-                        # should never happen
-                        v = [type, name]
-                    self.value.append(v)
-                i += 1
-                self.value = sorted(self.value)
-        else:
+        # walk the region keys once and group them by region index, instead
+        # of probing ~20 formatted keys per region
+        prefix = 'Xmp.mwg-rs.Regions/mwg-rs:'
+        dimensions = {}
+        regions = {}
+        hasRegionList = False
+        for key in imageMetadata.xmp_keys:
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if rest.startswith('RegionList['):
+                close = rest.find(']')
+                try:
+                    i = int(rest[11:close])
+                except ValueError:
+                    continue
+                regions.setdefault(i, {})[rest[close+2:]] = key
+            elif rest == 'RegionList':
+                hasRegionList = True
+            elif rest.startswith('AppliedToDimensions/stDim:'):
+                dimensions[rest[26:]] = key
+        if 'w' in dimensions and 'h' in dimensions:
+            self.AppliedToDimensions = (imageMetadata[dimensions['w']].value,
+                                        imageMetadata[dimensions['h']].value,
+                                        imageMetadata[dimensions['unit']].value if 'unit' in dimensions else None)
+        if not hasRegionList:
             self.value = None
+            return
+        def _float(fields, name):
+            if name in fields:
+                return float(imageMetadata[fields[name]].value)
+            return float('-inf')
+        self.value = []
+        i = 1
+        while i in regions:
+            fields = regions[i]
+            i += 1
+            # Area in RegionStruct is required
+            if 'mwg-rs:Area' not in fields:
+                continue
+            # OPTIONAL
+            # Type is optional closed choise
+            type = self.UNKNOWN
+            if 'mwg-rs:Type' in fields:
+                type = self.TYPES.get(imageMetadata[fields['mwg-rs:Type']].value.lower(), self.UNKNOWN)
+            # Name/short Description of Region is optional
+            name = ''
+            if 'mwg-rs:Name' in fields:
+                name = imageMetadata[fields['mwg-rs:Name']].value
+            # Description of Region is optional
+            description = ''
+            if 'mwg-rs:Description' in fields:
+                description = imageMetadata[fields['mwg-rs:Description']].value
+            #TODO: FocusUsage, BarCodeValue, Extensions
+            # parse REQUIRED Area values
+            xcenter = _float(fields, 'mwg-rs:Area/stArea:x')
+            ycenter = _float(fields, 'mwg-rs:Area/stArea:y')
+            width = _float(fields, 'mwg-rs:Area/stArea:w')
+            height = _float(fields, 'mwg-rs:Area/stArea:h')
+            diameter = _float(fields, 'mwg-rs:Area/stArea:d')
+            unit = 'normalized'
+            if 'mwg-rs:Area/stArea:unit' in fields:
+                unit = imageMetadata[fields['mwg-rs:Area/stArea:unit']].value
+            # and see what we've got
+            if (xcenter >= 0) and (ycenter >= 0):
+                # rectangle
+                if (width >= 0) and (height >= 0):
+                    v = Region.fromCenter(type | self.RECTANGLE, name, self.name, xcenter, ycenter, width, height)
+                # circle
+                elif (diameter >= 0):
+                    v = Region.fromCenter(type | self.CIRCLE, name, self.name, xcenter, ycenter, diameter, diameter)
+                # point
+                else:
+                    v = Region(type | self.POINT, name, self.name, xcenter, ycenter, 0.0, 0.0)
+            else:
+                # should never happen
+                v = Region(type, name, self.name)
+            self.value.append(v)
+        self.value.sort()
 
         
-class MdMPRI(Metadatum):
+class MdMPRI(MdRegions):
     """Xmp Microsoft Photo RegionInfo Schema
     
     @see http://msdn.microsoft.com/en-us/library/ee719905%28VS.85%29.aspx"""
-    ANYWHERE = 0
-    RECTANGLE = 4
-    FACE = 8
+    ANYWHERE = Region.ANYWHERE
+    RECTANGLE = Region.RECTANGLE
+    FACE = Region.FACE
+    NUMBER = r'\s*([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)\s*'
+    RECTANGLE_SYNTAX = re.compile('^%s$' % ','.join([NUMBER] * 4)) #: 'left, top, width, height'
     def __init__(self, value):
         super(MdMPRI, self).__init__(name='mp-ri', value=value, 
                                      key='Xmp.MP.RegionInfo',
                                      description='Metadata Working Group Region Schema Data')
     @classmethod
     def example(self):
-        """List of Tuples with [type, name, <x-left, y-top, width, height>]"""
-        return [ [self.FACE | self.ANYWHERE,  'John Doe' ],
-                 [self.FACE | self.RECTANGLE, 'Jane Doe', 0.6, 0.6, 0.1, 0.1] ]
+        """List of Regions, MPRI rectangles are stored by their upper left corner"""
+        return [ Region(self.FACE | self.ANYWHERE,  'John Doe', 'mp-ri'),
+                 Region(self.FACE | self.RECTANGLE, 'Jane Doe', 'mp-ri', 0.6, 0.6, 0.1, 0.1) ]
+    @classmethod
+    def parseRectangle(self, rectangle):
+        """Parses a MPReg:Rectangle string 'left, top, width, height' of four decimal numbers
+
+        @return: tuple of four floats
+        @raise ValueError: if rectangle is malformed"""
+        m = self.RECTANGLE_SYNTAX.match(rectangle)
+        if m is None:
+            raise ValueError('malformed MPReg:Rectangle %r' % rectangle)
+        return tuple(float(n) for n in m.groups())
     def parse(self, imageMetadata):
         if 'Xmp.MP.RegionInfo/MPRI:Regions' in imageMetadata:
             i = 1
@@ -185,10 +229,14 @@ class MdMPRI(Metadatum):
                     # Rectangle is optional, People may marked without any
                     if 'Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:Rectangle') in imageMetadata:
                         r = imageMetadata['Xmp.MP.RegionInfo/MPRI:Regions[%i]/%s' % (i, 'MPReg:Rectangle')].value
-                        left, top, width, height = eval(r)
-                        v = [self.FACE | self.RECTANGLE, name, left, top, width, height]
+                        try:
+                            left, top, width, height = self.parseRectangle(r)
+                            v = Region(self.FACE | self.RECTANGLE, name, self.name, left, top, width, height)
+                        except ValueError:
+                            # malformed rectangle, keep the person only
+                            v = Region(self.FACE | self.ANYWHERE, name, self.name)
                     else:
-                        v = [self.FACE | self.ANYWHERE, name]
+                        v = Region(self.FACE | self.ANYWHERE, name, self.name)
                 self.value.append(v)
                 i += 1
             self.value = sorted(self.value)
@@ -210,7 +258,7 @@ class WGS84Location(Metadatum):
 	        elif imageMetadata['Exif.GPSInfo.GPSLatitudeRef'].value == 'S':
                     latref = -1
 	        else:
-  	            print 'not interpretable GPSLatitudeRef:', imageMetadata['Exif.GPSInfo.GPSLatitudeRef'].value
+  	            sys.stderr.write('not interpretable GPSLatitudeRef: %s\n' % imageMetadata['Exif.GPSInfo.GPSLatitudeRef'].value)
         lonref = 0
         if 'Exif.GPSInfo.GPSLongitudeRef' in imageMetadata:
 	        if imageMetadata['Exif.GPSInfo.GPSLongitudeRef'].value == 'E':
@@ -218,7 +266,7 @@ class WGS84Location(Metadatum):
 	        elif imageMetadata['Exif.GPSInfo.GPSLongitudeRef'].value == 'W':
     	            lonref = -1
 	        else:
-  	            print 'not interpretable GPSLongitudeRef:', imageMetadata['Exif.GPSInfo.GPSLongitudeRef'].value
+  	            sys.stderr.write('not interpretable GPSLongitudeRef: %s\n' % imageMetadata['Exif.GPSInfo.GPSLongitudeRef'].value)
         flat = 0
         if 'Exif.GPSInfo.GPSLatitude' in imageMetadata:
 	    lat = imageMetadata['Exif.GPSInfo.GPSLatitude'].value
@@ -242,26 +290,113 @@ class WGS84Location(Metadatum):
         else:
             self.value = None
 
+
+class StoredPrivateMetadata(object):
+    """Private metadata restored from stored values, e.g. from a cache"""
+    def __init__(self, filename, values):
+        """@param values: dict of privateMetadata names to dumped Metadatum values,
+                          as returned by PrivateMetadata.privateValues()"""
+        super(StoredPrivateMetadata, self).__init__()
+        self.filename = filename
+        self.backend = 'stored'
+        self.privateMetadata = dict((name, PrivateMetadata.PARSERS[name].load(value)) for name, value in values.iteritems())
+    def privateValues(self):
+        return dict((name, metadatum.dump()) for name, metadatum in self.privateMetadata.iteritems())
+
+
+class LazyMetadata(collections.Mapping):
+    """Read-only mapping of names to Metadatum parsers' results
+
+    A parser runs on first access of its name only, its result is memoized."""
+    def __init__(self, source, parsers):
+        """@param source: the image metadata to parse
+           @param parsers: dict of names to Metadatum classes"""
+        super(LazyMetadata, self).__init__()
+        self.source = source
+        self.parsers = parsers
+        self.parsed = {}
+    def __getitem__(self, name):
+        if name not in self.parsed:
+            self.parsed[name] = self.parsers[name](self.source)
+        return self.parsed[name]
+    def __iter__(self):
+        return iter(self.parsers)
+    def __len__(self):
+        return len(self.parsers)
+    def __repr__(self):
+        return repr(dict(self.items()))
+
     
 class PrivateMetadata(pyexiv2.ImageMetadata):
     
+    BACKENDS = ('pyexiv2', 'header')
+    PARSERS = { 'people:mediapro': MdMediaproPpl,
+                'people:iptc4ext': MdIptc4ExtPpl,
+                'people:mwgrs': MdMwgRs,
+                'people:mpri': MdMPRI,
+                'location:wgs84': WGS84Location,
+              } #: privateMetadata names and their Metadatum parsers
+
     def __init__(self, filename=None):
         super(PrivateMetadata, self).__init__(filename)
         #self.imageMetadata = pyexiv2.ImageMetadata(filename)
         self.privateMetadata = None
+        self.buffer = None
+        self.backend = None
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        obj = super(PrivateMetadata, cls).from_buffer(buffer)
+        obj.buffer = buffer
+        return obj
+
+    @classmethod
+    def from_url(cls, url, http=None, complete=True):
+        """Returns the read PrivateMetadata of the JPEG file at url, its headers
+        are fetched by HTTP range requests without downloading the image
+
+        @param http: urllib3.PoolManager, to reuse its connections
+        @param complete: download the whole image if the header reader cannot
+                         handle it, to read it with pyexiv2; otherwise raise
+                         the reader's JpegHeaderError"""
+        obj = cls.from_buffer(download.fetchHeaders(url, http, complete=complete))
+        obj.read(backend='header')
+        return obj
     
-    def read(self):
+    def read(self, backend='pyexiv2'):
+        """Reads the metadata and parses the private metadata from it
+
+        @param backend: 'pyexiv2' reads all metadata with libexiv2,
+                        'header' reads only the JPEG headers needed for the
+                        private metadata and falls back to 'pyexiv2' if it
+                        cannot handle the file. Check self.backend for the
+                        backend actually used: only 'pyexiv2' fills the
+                        complete metadata, e.g. for a MetadataTree."""
+        if backend not in self.BACKENDS:
+            raise ValueError('unknown metadata backend %s, use one of %s' % (backend, self.BACKENDS))
+        if backend == 'header':
+            try:
+                if self.buffer is not None:
+                    md = jpeg_metadata.JpegHeaderMetadata.from_buffer(self.buffer)
+                else:
+                    md = jpeg_metadata.JpegHeaderMetadata.from_file(self.filename)
+            except jpeg_metadata.JpegHeaderError:
+                pass
+            else:
+                self.backend = 'header'
+                self.__parsePrivateMetadata(md)
+                return
         super(PrivateMetadata, self).read()
-        self.__parsePrivateMetadata()
+        self.backend = 'pyexiv2'
+        self.__parsePrivateMetadata(self)
     
-    def __parsePrivateMetadata(self):
-        # Persons, Faces, Regions
-        self.privateMetadata = {}
-        self.privateMetadata['people:mediapro'] = MdMediaproPpl(self)
-        self.privateMetadata['people:iptc4ext'] = MdIptc4ExtPpl(self)
-        self.privateMetadata['people:mwgrs'] = MdMwgRs(self)
-        self.privateMetadata['people:mpri'] = MdMPRI(self)
-        self.privateMetadata['location:wgs84'] = WGS84Location(self)
+    def privateValues(self):
+        """Returns a dict of all privateMetadata names to their values as builtin types"""
+        return dict((name, metadatum.dump()) for name, metadatum in self.privateMetadata.iteritems())
+
+    def __parsePrivateMetadata(self, md):
+        # Persons, Faces, Regions and Locations, parsed on first access
+        self.privateMetadata = LazyMetadata(md, self.PARSERS)
 
 
 def unifix(any):
@@ -273,6 +408,31 @@ def unifix(any):
         return unicode(any, errors='replace')
 
 
+KEY_CACHE_SIZE = 65536 #: maximum number of memoized splitKey results
+_keyCache = {}
+_keyNames = {}
+
+def splitKey(key, nsprefix=True):
+    """Splits a metadata key like 'Xmp.mwg-rs.Regions/mwg-rs:RegionList[1]'
+    into its path components, memoized for all images
+
+    @param nsprefix: keep namespace prefixes of components
+    @return: tuple of unicode components, equal components are the same object"""
+    try:
+        return _keyCache[(key, nsprefix)]
+    except KeyError:
+        pass
+    components = re.split(r'[./]', key.replace('[', '.['))
+    if nsprefix != True:
+        components = [c.split(':')[-1] for c in components]
+    components = tuple(_keyNames.setdefault(c, c) for c in (unifix(c) for c in components))
+    if len(_keyCache) >= KEY_CACHE_SIZE:
+        _keyCache.clear()
+        _keyNames.clear()
+    _keyCache[(key, nsprefix)] = components
+    return components
+
+
 class MetadataTree(object):
 
     class Node (object):
@@ -281,81 +441,133 @@ class MetadataTree(object):
             self.data = data
             self.parent = parent
             self.children = []
+            self.childindex = {} #: name -> first child of that name
         def add_child(self, child):
             self.children.append(child)
+            self.childindex.setdefault(child.name, child)
             child.parent = self
             return child
+        def replace_child(self, position, new):
+            """Puts new at position in children, new may have been renamed"""
+            old = self.children[position]
+            self.children[position] = new
+            if self.childindex.get(old.name) is old:
+                del self.childindex[old.name]
+            self.childindex.setdefault(new.name, new)
+            new.parent = self
+            return new
         def has_child_called(self, name):
-            return [child for child in self.children if child.name == name]
+            child = self.childindex.get(name)
+            return [child] if child is not None else []
+        def lines(self, depth=0):
+            """Yields the text lines of this node and its descendants
+            without recursion, a root node itself is not shown"""
+            if self.parent is None:
+                stack = [(child, depth) for child in reversed(self.children)]
+            else:
+                stack = [(self, depth)]
+            while stack:
+                node, d = stack.pop()
+                yield u'%s%s: %s' % (u' '*d, unifix(node.name), unifix(node.data))
+                stack.extend((child, d+1) for child in reversed(node.children))
         def __str__(self, depth=0):
+            ret = u'\n'.join(self.lines(depth))
             if self.parent is not None:
-                myname = u'%s%s: %s\n' % (u' '*depth, unifix(self.name), unifix(self.data))
+                return ret + u'\n'
             else:
-                myname = u''
-                depth=-1
-            mychildren = u''
-            for child in self.children:
-                mychildren += child.__str__(depth=depth+1)
-            ret = u'%s%s' % (myname, mychildren)
-            if self.parent is not None:
                 return ret
-            else:
-                return ret.rstrip('\n')
             
     def __init__(self, metadata, nsprefix=True, stripSingleChildNodes=True):
-        """@param nsprefix: suppress namespace prefixes if possible
+        """@param metadata: image metadata, or None for an empty tree
+           @param nsprefix: suppress namespace prefixes if possible
            @param stripSingleChildNodes: if a node has only one child combine them to lower hierarchy depth"""
         super(MetadataTree, self).__init__()
         self.root = None
-        self.loadMetadata(metadata, nsprefix=nsprefix)
+        if metadata is not None:
+            self.loadMetadata(metadata, nsprefix=nsprefix)
         if stripSingleChildNodes == True:
             self.stripSingleChildNodes()
+
+    def serialize(self):
+        """Returns the tree as a flat list of (name, data, number of children)
+        tuples of builtin types in preorder, data converted to unicode as it
+        is displayed. Flat, so deep trees neither recurse nor nest."""
+        if self.root is None:
+            return None
+        serialized = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            data = None if node.data is None else unifix(node.data)
+            serialized.append((node.name, data, len(node.children)))
+            stack.extend(reversed(node.children))
+        return serialized
+
+    @classmethod
+    def deserialize(cls, serialized):
+        """Returns a MetadataTree from the output of serialize()"""
+        tree = cls(None, stripSingleChildNodes=False)
+        if serialized is None:
+            return tree
+        stack = [] #: [node, children still to add]
+        for name, data, n in serialized:
+            node = cls.Node(data=data, name=name, parent=None)
+            if not stack:
+                tree.root = node
+            else:
+                stack[-1][0].add_child(node)
+                stack[-1][1] -= 1
+                if stack[-1][1] == 0:
+                    stack.pop()
+            if n > 0:
+                stack.append([node, n])
+        return tree
         
     def loadMetadata(self, metadata, nsprefix=True):
-        def _multisplit(s, seps=['.','/'], nsprefix=True):
-            res = [s.replace('[', '.[')]
-            for sep in seps:
-                s, res = res, []
-                for seq in s:
-                    res += seq.split(sep)
-            if nsprefix == True:
-                return res
-            else:
-                return [e.split(':')[-1] for e in res]
         if len(metadata.keys()) > 0:
             self.root = self.Node(data=None, name=u'', parent=None)
             for k, v in metadata.iteritems():
                 currentnode = self.root
-                for nodename in _multisplit(k, nsprefix=nsprefix):
-                    thatchild = currentnode.has_child_called(nodename)
-                    if len(thatchild) == 0:
-                        currentnode = currentnode.add_child(self.Node(data=None, name=nodename, parent=None))
-                    else:
-                        currentnode = thatchild[0]
+                for nodename in splitKey(k, nsprefix=nsprefix):
+                    thatchild = currentnode.childindex.get(nodename)
+                    if thatchild is None:
+                        thatchild = currentnode.add_child(self.Node(data=None, name=nodename, parent=None))
+                    currentnode = thatchild
                 try:
                     currentnode.data = v.value
                 except:
                     currentnode.data = v.raw_value
             
     def stripSingleChildNodes(self):
-        def _recur(node):
-            if len(node.children) > 0:
-                for currentnode in node.children:
-                    if (len(currentnode.children) == 1) and ((currentnode.data == None) or (currentnode.data == u'')) and not (currentnode.name.startswith('[')):
-                        currentnode.children[0].name = currentnode.name+u'|'+currentnode.children[0].name
-                        currentnode.children[0].parent = currentnode.parent
-                        currentnode.parent.children[currentnode.parent.children.index(currentnode)] = currentnode.children[0]
-                        #print currentnode.name
-                        #print [n.name for n in currentnode.parent.children]
-                        #print currentnode.parent.children[currentnode.parent.children.index(currentnode)].name
-                        #print currentnode.children[0]
-                    _recur(currentnode)
+        """Combines nodes without data having a single child with that child, in one pass"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for position, currentnode in enumerate(node.children):
+                while (len(currentnode.children) == 1) and ((currentnode.data == None) or (currentnode.data == u'')) and not (currentnode.name.startswith('[')):
+                    child = currentnode.children[0]
+                    child.name = currentnode.name+u'|'+child.name
+                    currentnode = node.replace_child(position, child)
+                stack.append(currentnode)
+
+    def lines(self):
+        """Yields the text lines of the tree"""
         if self.root is not None:
-            _recur(self.root)
-        
-        
+            for line in self.root.lines():
+                yield line
+
+    def write(self, f, encoding='utf-8'):
+        """Writes the tree line by line to file-like object f, e.g. a file or socket.makefile()
+
+        @param encoding: encoding of the lines written, None writes unicode"""
+        for line in self.lines():
+            line += u'\n'
+            f.write(line.encode(encoding) if encoding is not None else line)
+
     def __str__(self):
-        return self.root.__str__()
+        return u'\n'.join(self.lines())
 	
 
 
@@ -378,6 +590,84 @@ def test():
     print '%s\n' % p.privateMetadata
     print '%s\n' % MetadataTree(p, nsprefix=False, stripSingleChildNodes=True)
 
+
+def listJpgs(paths):
+    """Yields the JPEG files in paths and the directory trees below them"""
+    for path in paths:
+        if os.path.isdir(path):
+            for dir, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    if file.lower().endswith('.jpg'):
+                        yield os.path.join(dir, file)
+        else:
+            yield path
+
+def isURL(path):
+    return path.startswith('http://') or path.startswith('https://')
+
+_http = None #: urllib3.PoolManager of a scan() worker process
+
+def scanFile(args):
+    """Returns the private metadata of a file or URL as JSON line, runs in scan()'s worker processes"""
+    global _http
+    filename, backend = args
+    result = {'file': filename}
+    try:
+        if isURL(filename):
+            if _http is None:
+                _http = download.urllib3.PoolManager()
+            md = PrivateMetadata.from_url(filename, _http)
+        else:
+            md = PrivateMetadata(filename)
+            md.read(backend=backend)
+        result.update(md.privateValues())
+    except Exception as strerror:
+        result['error'] = str(strerror)
+    try:
+        return json.dumps(result, default=unifix)
+    except UnicodeDecodeError:
+        return json.dumps(result, default=unifix, encoding='latin-1')
+
+def scan(paths, backend='header', processes=None, out=sys.stdout):
+    """Extracts private metadata of all JPEG files in paths in a process pool,
+    writing one JSON line per image to out
+
+    @param processes: number of worker processes, default: one per CPU
+    @return: number of images scanned"""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    count = 0
+    try:
+        for line in pool.imap_unordered(scanFile, ((f, backend) for f in listJpgs(paths)), chunksize=32):
+            out.write(line+'\n')
+            count += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return count
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='private_metadata.py scan',
+                                     description='Scan JPEG files for private metadata, one JSON line per image')
+    parser.add_argument('paths', nargs='+', help='JPEG files, directories to scan recursively or http(s) URLs')
+    parser.add_argument('-b', '--backend', choices=PrivateMetadata.BACKENDS, default='header',
+                        help='metadata reader, header falls back to pyexiv2 if necessary (default: header)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    args = parser.parse_args(argv)
+    start = time.time()
+    count = scan(args.paths, backend=args.backend, processes=args.processes)
+    elapsed = time.time() - start
+    sys.stderr.write('%i images in %.2f s: %.1f images/sec\n' % (count, elapsed, count / elapsed if elapsed > 0 else 0))
+
   
 if __name__ == '__main__':
-    test()
+    if len(sys.argv) > 1 and sys.argv[1] == 'scan':
+        main(sys.argv[2:])
+    else:
+        test()
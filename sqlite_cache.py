@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Base of the persistent caches indexed by an SQLite database
+
+Handles what the caches share: the database connection usable from any
+thread, dropping tables of an outdated schema, the total size of the
+entries and least recently used eviction. Methods are serialized by a
+lock, so a cache may be shared by threads."""
+
+import os
+import sqlite3
+import threading
+
+__author__ = "B. Henne"
+__contact__ = "henne@dcsec.uni-hannover.de"
+__copyright__ = "(c) 2012, B. Henne"
+__license__ = "GPLv3"
+
+
+class SQLiteCache(object):
+    """Size-bounded cache whose entries are rows of the table TABLE with
+    the columns KEY, SIZE and used (time of last use)"""
+
+    SCHEMA_VERSION = 1 #: increase on changes of tables or stored data
+    TABLES = {} #: table name -> column definitions
+    INDEXES = {} #: index name -> (table name, column)
+    TABLE = None #: table of the evicted entries
+    KEY = None #: primary key column of TABLE
+    SIZE = None #: column of the entries' sizes in bytes
+
+    def __init__(self, filename, maxsize):
+        """@param filename: SQLite database file, its directory is created if needed
+           @param maxsize: maximum size of all entries in bytes"""
+        super(SQLiteCache, self).__init__()
+        dir = os.path.dirname(filename)
+        if dir != '' and not os.path.isdir(dir):
+            os.makedirs(dir, 0755)
+        self.filename = filename
+        self.maxsize = maxsize
+        self.uncommitted = 0
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            for table in self.TABLES:
+                self.db.execute('DROP TABLE IF EXISTS %s' % table)
+            self.schemaReset()
+            self.db.execute('PRAGMA user_version=%i' % self.SCHEMA_VERSION)
+        for table, columns in self.TABLES.iteritems():
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, columns))
+        for index, (table, column) in self.INDEXES.iteritems():
+            self.db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (index, table, column))
+        self.db.commit()
+        self.totalsize = self.db.execute('SELECT COALESCE(SUM(%s), 0) FROM %s' % (self.SIZE, self.TABLE)).fetchone()[0]
+
+    def evict(self, size, keep=None):
+        """Removes least recently used entries until at most size bytes are stored
+
+        @param keep: key of an entry not to remove"""
+        with self.lock:
+            removed = []
+            for key, entrysize in self.db.execute('SELECT %s, %s FROM %s ORDER BY used' % (self.KEY, self.SIZE, self.TABLE)):
+                if self.totalsize <= size:
+                    break
+                if key == keep:
+                    continue
+                removed.append((key,))
+                self.totalsize -= entrysize
+            self.evicted(removed)
+            self.db.executemany('DELETE FROM %s WHERE %s = ?' % (self.TABLE, self.KEY), removed)
+
+    def schemaReset(self):
+        """Called when the tables of an outdated schema were dropped, e.g. to
+        remove data stored outside the database"""
+        pass
+
+    def evicted(self, keys):
+        """Called with the (key,) tuples of entries before they are evicted"""
+        pass
+
+    def clear(self):
+        with self.lock:
+            self.evict(-1)
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM %s' % self.TABLE).fetchone()[0]